@@ -0,0 +1,527 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# benchmark.py
+#
+# Benchmarks for the pieces of git-issues that dominate its running time.
+# Run it from the directory holding git-issues:
+#
+#   python benchmark.py [options] [name...]
+#
+# The first few benchmarks time the XML layer on its own.  The rest are run
+# against throwaway repositories, generated with `git fast-import' for each
+# size given with --issues (e.g. --issues 1k,10k,100k), and time gitshelve,
+# the issues cache and the git-issues commands themselves.  Nothing beyond
+# a local `git' binary is needed.
+#
+# Each benchmark prints the best time out of several runs, except those that
+# change the repository, which are only run once.  With --report, the results
+# are also written out as JSON, so that they can be compared between
+# revisions.
+
+import os
+import sys
+import imp
+import time
+import shutil
+import tempfile
+import threading
+import optparse
+import subprocess
+from datetime import datetime
+from timeit import default_timer
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+
+import gitshelve
+
+
+def load_git_issues():
+    """Import the git-issues script as a module, without running a
+    command."""
+    argv = sys.argv
+    sys.argv = [os.path.join(here, 'git-issues')]
+    try:
+        return imp.load_source('git_issues', sys.argv[0])
+    finally:
+        sys.argv = argv
+
+
+def best_of(repeat, func, *args):
+    best = None
+    for i in range(repeat):
+        start = default_timer()
+        func(*args)
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def make_issue(gi, description_size):
+    issue = gi.Issue(None, gi.Person("Jo Tester", "jo@example.com"),
+                     "A sample issue title",
+                     summary="A short summary of the issue",
+                     description=("Lorem ipsum dolor sit amet.\n" *
+                                  (description_size / 28 + 1))
+                                 [:description_size])
+    issue.created = datetime(2012, 1, 2, 3, 4, 5)
+    return issue
+
+
+def bench_serialize(gi, options):
+    issue = make_issue(gi, options.description_size)
+
+    def serialize():
+        for i in xrange(options.count):
+            gi.object_to_string(issue)
+
+    return best_of(options.repeat, serialize)
+
+
+def bench_parse(gi, options):
+    data = gi.object_to_string(make_issue(gi, options.description_size))
+
+    def parse():
+        for i in xrange(options.count):
+            gi.object_from_string(data)
+
+    return best_of(options.repeat, parse)
+
+
+def bench_parse_header(gi, options):
+    data = gi.object_to_string(make_issue(gi, options.description_size))
+
+    def parse():
+        for i in xrange(options.count):
+            gi.object_from_string(data, ('title', 'status', 'created',
+                                         'author'))
+
+    return best_of(options.repeat, parse)
+
+
+benchmarks = [
+    ('serialize', bench_serialize,
+     'object_to_string on COUNT issues with large descriptions'),
+    ('parse', bench_parse,
+     'object_from_string on COUNT issues with large descriptions'),
+    ('parse-header', bench_parse_header,
+     'the same, decoding only the fields shown by "list"'),
+]
+
+######################################################################
+
+
+class Repository:
+    """A throwaway repository holding a synthetic issues branch."""
+    def __init__(self, gi, options, count):
+        self.path = tempfile.mkdtemp(prefix='git-issues-bench-')
+        self.git_dir = os.path.join(self.path, '.git')
+        self.count = count
+        self.issue_ids = []
+        self.issue_paths = []
+
+        subprocess.check_call(('git', 'init', '-q', self.path))
+        self.git('config', 'user.name', 'Bench Mark')
+        self.git('config', 'user.email', 'bench@example.com')
+
+        cwd = os.getcwd()
+        os.chdir(self.path)
+        try:
+            self.generate(gi, options)
+        finally:
+            os.chdir(cwd)
+
+    def git(self, *args):
+        return gitshelve.git(*args, **{'repository': self.git_dir})
+
+    def generate(self, gi, options):
+        """Write COUNT issues, each with its comments, and then a history
+        of commits that each change a few of them, in one fast-import
+        session."""
+        issueSet = gi.GitIssueSet()
+        author = issueSet.current_author()
+        ident = unicode(author)
+        importer = gitshelve.gitimport(self.git_dir)
+        marks = {}
+        issues = []
+        description = "Lorem ipsum dolor sit amet.\n" * 20
+
+        for i in xrange(self.count):
+            issue = gi.GitIssue(issueSet, author, "Synthetic issue %d" % i,
+                                summary="Summary of issue %d" % i,
+                                description=description)
+            issue.status = "TODO"
+            path = issueSet.issue_path(issue)
+            marks[path] = importer.blob(gi.object_to_string(issue))
+            issues.append((issue, path))
+            self.issue_ids.append(issue.get_name())
+            self.issue_paths.append(path)
+
+            for j in xrange(options.comments):
+                comment = gi.GitComment(issue, author,
+                                        "Comment %d on issue %d" % (j, i))
+                marks[issueSet.comment_path(comment)] = \
+                    importer.blob(gi.object_to_string(comment))
+
+        parent = None
+        edited = 0
+        for depth in xrange(options.history):
+            if depth > 0:
+                for k in xrange(min(options.edits, self.count)):
+                    issue, path = issues[edited % self.count]
+                    issue.status = ("TODO", "STARTED")[depth % 2]
+                    marks[path] = importer.blob(gi.object_to_string(issue))
+                    edited += 1
+            entries = ['M 100644 :%d %s' % (mark, gitshelve.quote_path(path))
+                       for path, mark in sorted(marks.items())]
+            mark = importer.commit(ident, ident,
+                                   "Synthetic change %d\n" % depth,
+                                   parent, entries)
+            parent = ':%d' % mark
+
+        head = importer.get_mark(mark)
+        importer.close()
+        self.git('update-ref', 'refs/heads/issues', head)
+        self.git('config', 'issues.branch', 'issues')
+
+    def remove_cache(self):
+        cache_file = os.path.join(self.git_dir, 'issues')
+        if os.path.isfile(cache_file):
+            os.remove(cache_file)
+
+    def run(self, *args, **kwargs):
+        """Run git-issues in the repository, as a user would.  Any input
+        keyword is fed to the command on stdin, and its output is returned
+        if the output keyword is true."""
+        devnull = open(os.devnull, 'w')
+        try:
+            proc = subprocess.Popen((sys.executable,
+                                     os.path.join(here, 'git-issues')) + args,
+                                    cwd=self.path, stdin=subprocess.PIPE,
+                                    stdout=kwargs.get('output') and
+                                    subprocess.PIPE or devnull)
+            output = proc.communicate(kwargs.get('input', ''))[0]
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, args)
+            return output
+        finally:
+            devnull.close()
+
+    def remove(self):
+        shutil.rmtree(self.path)
+
+
+def bench_open(gi, options, repo):
+    return best_of(options.repeat,
+                   lambda: gitshelve.open('issues').close())
+
+
+def bench_open_lazy(gi, options, repo):
+    return best_of(options.repeat,
+                   lambda: gitshelve.open('issues', lazy=True).close())
+
+
+def bench_commit(gi, options, repo):
+    shelf = gitshelve.open('issues', lazy=True)
+    for path in repo.issue_paths[:options.edits]:
+        shelf[path] = shelf[path].replace('<status>TODO', '<status>DONE')
+    start = default_timer()
+    shelf.commit('Benchmark edits\n')
+    elapsed = default_timer() - start
+    shelf.close()
+    return elapsed
+
+
+def bench_load_cold(gi, options, repo):
+    repo.remove_cache()
+    start = default_timer()
+    issueSet = gi.GitIssueSet().load_state()
+    issueSet.get_field_index()
+    return default_timer() - start
+
+
+def bench_load_warm(gi, options, repo):
+    repo.remove_cache()
+    gi.GitIssueSet().load_state().save_state()
+    elapsed = best_of(options.repeat,
+                      lambda: gi.GitIssueSet().load_state())
+    # The cache written here refers to classes of this process's copy of
+    # git-issues, which the commands run below cannot read
+    repo.remove_cache()
+    return elapsed
+
+
+def bench_list_cold(gi, options, repo):
+    repo.remove_cache()
+    start = default_timer()
+    repo.run('list')
+    return default_timer() - start
+
+
+def bench_list(gi, options, repo):
+    repo.run('list')                    # make sure the cache is there
+    return best_of(options.repeat, repo.run, 'list')
+
+
+def bench_list_daemon(gi, options, repo):
+    daemon = subprocess.Popen((sys.executable,
+                               os.path.join(here, 'git-issues'), 'daemon'),
+                              cwd=repo.path)
+    try:
+        socket_path = os.path.join(repo.git_dir, 'issues.sock')
+        while not os.path.exists(socket_path):
+            if daemon.poll() is not None:
+                raise RuntimeError("git-issues daemon failed to start")
+            time.sleep(0.05)
+        repo.run('list')                # the first request reads the issues
+        return best_of(options.repeat, repo.run, 'list')
+    finally:
+        repo.run('daemon', 'stop')
+        daemon.wait()
+
+
+def bench_show(gi, options, repo):
+    return best_of(options.repeat, repo.run, 'show', repo.issue_ids[0][:7])
+
+
+def bench_search_cold(gi, options, repo):
+    repo.run('list')                    # a cache without a text index
+    start = default_timer()
+    repo.run('search', 'synthetic', 'issue')
+    return default_timer() - start
+
+
+def bench_search(gi, options, repo):
+    return best_of(options.repeat, repo.run, 'search', 'summary', 'OR',
+                   'comm*')
+
+
+def bench_log_cold(gi, options, repo):
+    repo.run('list')                    # a cache without a history index
+    start = default_timer()
+    repo.run('log', repo.issue_ids[0][:7])
+    return default_timer() - start
+
+
+def bench_log(gi, options, repo):
+    return best_of(options.repeat, repo.run, 'log', repo.issue_ids[0][:7])
+
+
+def bench_new(gi, options, repo):
+    start = default_timer()
+    repo.run('new', 'A benchmarked issue')
+    return default_timer() - start
+
+
+def bench_comment(gi, options, repo):
+    start = default_timer()
+    repo.run('comment', repo.issue_ids[-1][:7], 'A benchmarked comment')
+    return default_timer() - start
+
+
+def bench_writers(gi, options, repo):
+    """Have four writers comment on the same issues at once, each waiting
+    for its previous comment, and return the time taken per comment."""
+    failures = []
+
+    def writer(number):
+        for i in xrange(5):
+            try:
+                repo.run('--no-daemon', 'comment', repo.issue_ids[i][:7],
+                         'Comment %d from writer %d' % (i, number))
+            except subprocess.CalledProcessError, e:
+                failures.append(e)
+
+    threads = [threading.Thread(target=writer, args=(number,))
+               for number in xrange(4)]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = default_timer() - start
+    if failures:
+        raise failures[0]
+    return elapsed / 20
+
+
+def bench_batch(gi, options, repo):
+    lines = [json.dumps({'op': 'change', 'issue': name, 'field': 'priority',
+                         'value': 'high'})
+             for name in repo.issue_ids[:options.edits]]
+    start = default_timer()
+    repo.run('batch', input='\n'.join(lines) + '\n')
+    return default_timer() - start
+
+
+
+def bench_export(gi, options, repo):
+    return best_of(options.repeat, repo.run, 'export')
+
+
+def bench_import(gi, options, repo):
+    data = repo.run('export', output=True)
+    path = tempfile.mkdtemp(prefix='git-issues-bench-')
+    try:
+        subprocess.check_call(('git', 'init', '-q', path))
+        devnull = open(os.devnull, 'w')
+        start = default_timer()
+        proc = subprocess.Popen((sys.executable,
+                                 os.path.join(here, 'git-issues'), 'import'),
+                                cwd=path, stdin=subprocess.PIPE,
+                                stdout=devnull)
+        proc.communicate(data)
+        elapsed = default_timer() - start
+        devnull.close()
+    finally:
+        shutil.rmtree(path)
+    return elapsed
+
+
+repository_benchmarks = [
+    ('open', bench_open,
+     'gitshelve.open, reading the whole tree'),
+    ('open-lazy', bench_open_lazy,
+     'gitshelve.open with lazy=True'),
+    ('commit', bench_commit,
+     'gitshelve commit after EDITS changed issues (once)'),
+    ('load-cold', bench_load_cold,
+     'IssueSet.load_state without a cache, and indexing fields (once)'),
+    ('load-warm', bench_load_warm,
+     'IssueSet.load_state from the cache'),
+    ('list-cold', bench_list_cold,
+     '"git-issues list" without a cache (once)'),
+    ('list', bench_list,
+     '"git-issues list"'),
+    ('list-daemon', bench_list_daemon,
+     '"git-issues list" answered by "git-issues daemon"'),
+    ('show', bench_show,
+     '"git-issues show"'),
+    ('search-cold', bench_search_cold,
+     '"git-issues search", indexing every issue and comment (once)'),
+    ('search', bench_search,
+     '"git-issues search" with the text index cached'),
+    ('log-cold', bench_log_cold,
+     '"git-issues log", indexing the history of the branch (once)'),
+    ('log', bench_log,
+     '"git-issues log" with the history index cached'),
+    ('new', bench_new,
+     '"git-issues new" (once)'),
+    ('comment', bench_comment,
+     '"git-issues comment" (once)'),
+    ('writers', bench_writers,
+     '"git-issues comment" from 4 writers at once, per comment (once)'),
+    ('batch', bench_batch,
+     '"git-issues batch" changing EDITS issues (once)'),
+    ('export', bench_export,
+     '"git-issues export" as JSON lines'),
+    ('import', bench_import,
+     '"git-issues import" of that into an empty repository (once)'),
+]
+
+######################################################################
+
+
+def parse_size(text):
+    """Read a count such as 1000, 10k or 1m."""
+    text = text.strip().lower()
+    for suffix, factor in (('k', 1000), ('m', 1000000)):
+        if text.endswith(suffix):
+            return int(text[:-len(suffix)]) * factor
+    return int(text)
+
+
+def current_revision():
+    try:
+        return gitshelve.git('rev-parse', 'HEAD',
+                             repository=os.path.join(here, '.git'))
+    except gitshelve.GitError:
+        return None
+
+
+def main():
+    parser = optparse.OptionParser(usage="Usage: %prog [options] [name...]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=5,
+                      help="number of runs to take the best time of")
+    parser.add_option("--count", dest="count", type="int", default=200,
+                      help="number of objects handled per run")
+    parser.add_option("--description-size", dest="description_size",
+                      type="int", default=64 * 1024,
+                      help="size in bytes of each issue's description")
+    parser.add_option("--issues", dest="issues", default="1k",
+                      help="comma separated sizes of the repositories to "
+                      "generate, or an empty string for none")
+    parser.add_option("--comments", dest="comments", type="int", default=2,
+                      help="number of comments on each generated issue")
+    parser.add_option("--history", dest="history", type="int", default=10,
+                      help="number of commits in each generated history")
+    parser.add_option("--edits", dest="edits", type="int", default=100,
+                      help="number of issues changed by each commit")
+    parser.add_option("--report", dest="report", default=None,
+                      metavar="FILE",
+                      help="also write the results to FILE as JSON")
+    parser.add_option("--keep", dest="keep", action="store_true",
+                      default=False,
+                      help="do not remove the generated repositories")
+    (options, args) = parser.parse_args()
+
+    gi = load_git_issues()
+    results = []
+
+    def report(name, elapsed, description, issues=None):
+        print "%-12s %9.2f ms  %s" % (name, elapsed * 1000.0, description)
+        results.append({'name': name, 'issues': issues, 'seconds': elapsed,
+                        'description': description})
+
+    for name, func, description in benchmarks:
+        if args and not name in args:
+            continue
+        report(name, func(gi, options), description)
+
+    selected = [benchmark for benchmark in repository_benchmarks
+                if not args or benchmark[0] in args]
+    sizes = [parse_size(size) for size in options.issues.split(',')
+             if size.strip()]
+    for count in selected and sizes or []:
+        print
+        print "%d issues, %d comments each, %d commits of history:" % \
+            (count, options.comments, options.history)
+        start = default_timer()
+        repo = Repository(gi, options, count)
+        report('generate', default_timer() - start,
+               'writing the repository with fast-import', count)
+
+        cwd = os.getcwd()
+        os.chdir(repo.path)
+        try:
+            for name, func, description in selected:
+                report(name, func(gi, options, repo), description, count)
+        finally:
+            os.chdir(cwd)
+            if options.keep:
+                print "Kept repository in %s" % repo.path
+            else:
+                repo.remove()
+
+    if options.report:
+        fd = open(options.report, 'w')
+        try:
+            json.dump({'revision': current_revision(),
+                       'python': sys.version.split()[0],
+                       'options': vars(options),
+                       'results': results}, fd, indent=2, sort_keys=True)
+            fd.write('\n')
+        finally:
+            fd.close()
+
+if __name__ == '__main__':
+    main()
+
+# benchmark.py ends here
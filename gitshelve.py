@@ -32,12 +32,19 @@
 
 import re
 import os
+import stat
+import time
+import hashlib
+import random
+import copy_reg
+import __builtin__
 
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 
+from binascii import hexlify, unhexlify
 from subprocess import Popen, PIPE
 from string import split, join
 
@@ -47,6 +54,54 @@ verbose = False
 
 ######################################################################
 
+# Instrumentation.  Every call to Git, including each exchange with a
+# long-running batch or fast-import process, is reported to the functions in
+# `hooks', as are any other measurements passed to `notify' (git-issues uses
+# it for XML and cache timings).  Each hook is called as:
+#
+#   hook(kind, name, elapsed, input_bytes, output_bytes, count)
+#
+# where kind is 'git' for a Git command named by name, elapsed is the wall
+# time in seconds, the byte counts are what was sent to and received from
+# Git, and count is how many objects were handled, if that means anything.
+# Nothing is timed while there are no hooks.
+
+hooks = []
+
+
+def notify(kind, name, elapsed, input_bytes=0, output_bytes=0, count=1):
+    for hook in hooks:
+        hook(kind, name, elapsed, input_bytes, output_bytes, count)
+
+
+class gitstats:
+    """A hook totalling up everything reported to it, by kind and name."""
+    def __init__(self):
+        self.totals = {}
+
+    def __call__(self, kind, name, elapsed, input_bytes, output_bytes,
+                 count):
+        key = (kind, name)
+        if not key in self.totals:
+            self.totals[key] = [0, 0, 0.0, 0, 0]
+        total = self.totals[key]
+        total[0] += 1
+        total[1] += count
+        total[2] += elapsed
+        total[3] += input_bytes
+        total[4] += output_bytes
+
+    def summary(self):
+        """Return a dict for each kind and name seen, slowest first."""
+        rows = [{'kind': kind, 'name': name, 'calls': total[0],
+                 'count': total[1], 'elapsed': total[2],
+                 'input_bytes': total[3], 'output_bytes': total[4]}
+                for (kind, name), total in self.totals.items()]
+        rows.sort(key=lambda row: row['elapsed'], reverse=True)
+        return rows
+
+######################################################################
+
 # Utility function for calling out to Git (this script does not try to
 # be a Git library, just an interface to the underlying commands).  It
 # supports a 'restart' keyword, which will cause a Python function to
@@ -75,6 +130,12 @@ class GitError(Exception):
         return self.__unicode__()
 
 
+class HeadMoved(GitError):
+    """Raised when a commit could not be made the head of its branch, because
+    the branch was moved by someone else since the shelf last looked."""
+    pass
+
+
 def git(cmd, *args, **kwargs):
     restart = True
     while restart:
@@ -109,6 +170,9 @@ def git(cmd, *args, **kwargs):
             if not os.path.isdir(work_tree):
                 os.makedirs(work_tree)
 
+        if hooks:
+            start = time.time()
+
         proc = Popen(('git', cmd) + args, env=environ,
                      stdin=stdin_mode,
                      stdout=PIPE,
@@ -123,6 +187,9 @@ def git(cmd, *args, **kwargs):
             input = input.encode("utf-8")
         out, err = proc.communicate(input)
 
+        if hooks:
+            notify('git', cmd, time.time() - start, len(input), len(out))
+
         returncode = proc.returncode
         restart = False
         ignore_errors = 'ignore_errors' in kwargs and kwargs['ignore_errors']
@@ -140,9 +207,528 @@ def git(cmd, *args, **kwargs):
             return unicode(out[:-1], "utf-8")
 
 
-class gitbook:
+def hash_object(kind, data):
+    """Compute the name Git would give an object of the given kind holding
+    data, without asking Git."""
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    return unicode(hashlib.sha1('%s %d\0%s' % (kind, len(data), data))
+                   .hexdigest())
+
+
+def tree_sort_key(entry):
+    # Git orders tree entries by name, with subtrees sorting as if their
+    # names ended with a slash.
+    if entry[0] == '40000':
+        return entry[1] + '/'
+    return entry[1]
+
+
+def hash_tree(entries):
+    """Compute the name of the tree holding the given (mode, name, sha)
+    entries, where mode is either '100644' or '40000'."""
+    buf = StringIO()
+    for mode, name, sha in sorted([(mode, isinstance(name, unicode) and
+                                    name.encode("utf-8") or name, sha)
+                                   for mode, name, sha in entries],
+                                  key=tree_sort_key):
+        buf.write('%s %s\0%s' % (mode, name, unhexlify(sha)))
+    return hash_object('tree', buf.getvalue())
+
+
+def parse_tree(data):
+    """Split the raw contents of a tree object into (mode, name, sha)
+    entries."""
+    entries = []
+    pos = 0
+    while pos < len(data):
+        space = data.index(' ', pos)
+        nul = data.index('\0', space)
+        entries.append((data[pos:space], unicode(data[space + 1:nul], "utf-8"),
+                        unicode(hexlify(data[nul + 1:nul + 21]))))
+        pos = nul + 21
+    return entries
+
+
+def git_environ(repository):
+    """Return the environment for a long-running Git process working on the
+    given repository, or None to inherit our own."""
+    if not repository:
+        return None
+    environ = os.environ.copy()
+    environ['GIT_DIR'] = repository
+    return environ
+
+
+def git_stream(args, repository=None, stdin=None):
+    """Start the Git command given by args, with its output (and its input,
+    if stdin is PIPE) left on pipes for the caller to go through a chunk at
+    a time, for data too large for git() to hold in memory."""
+    if verbose:
+        print "Command: git %s" % join(args, ' ')
+    if repository and not os.path.isdir(repository):
+        proc = Popen(('git', 'init'), env=git_environ(repository),
+                     stdout=PIPE, stderr=PIPE)
+        if proc.wait() != 0:
+            raise GitError('init', [], {}, proc.stderr.read())
+    return Popen(('git',) + tuple(args), env=git_environ(repository),
+                 stdin=stdin, stdout=PIPE, stderr=PIPE)
+
+
+def quote_path(path):
+    """Quote a path the way `git fast-import' expects, if it needs it."""
+    if isinstance(path, unicode):
+        path = path.encode("utf-8")
+    if not path or path[0] == '"' or '\n' in path or '\\' in path:
+        return '"%s"' % path.replace('\\', '\\\\').replace('"', '\\"') \
+                            .replace('\n', '\\n')
+    return path
+
+######################################################################
+
+# Reading the repository directly.  Looking up a ref or a configuration
+# value costs a whole Git process, which is most of the running time of a
+# quick command.  The functions below read the few files involved
+# themselves, and only ask Git when the repository is set up in a way they
+# do not understand (in which case they return None, or fall back to a
+# single Git call).
+
+config_env = ('GIT_CONFIG', 'GIT_CONFIG_GLOBAL', 'GIT_CONFIG_SYSTEM',
+              'GIT_CONFIG_PARAMETERS', 'GIT_CONFIG_COUNT')
+
+config_key_pat = re.compile(r'([A-Za-z][-A-Za-z0-9]*)\s*(=\s*(.*))?$')
+config_section_pat = \
+    re.compile(r'\[\s*([-.A-Za-z0-9]+)(\s+"((?:[^"\\]|\\.)*)")?\s*\]')
+config_escapes = {'n': '\n', 't': '\t', 'b': '\b', '"': '"', '\\': '\\'}
+
+
+def find_git_dir(repository=None):
+    """Return the Git directory that commands run from here would use, or
+    None if finding it would take more than looking for `.git' above the
+    current directory."""
+    if repository:
+        return repository
+    if 'GIT_DIR' in os.environ:
+        return os.environ['GIT_DIR']
+    if 'GIT_CEILING_DIRECTORIES' in os.environ:
+        return None
+
+    path = os.getcwd()
+    while True:
+        candidate = os.path.join(path, '.git')
+        if os.path.isdir(candidate):
+            return candidate
+        if os.path.isfile(candidate):
+            # A worktree or submodule, whose Git directory is elsewhere
+            fd = __builtin__.open(candidate)
+            try:
+                line = fd.readline().strip()
+            finally:
+                fd.close()
+            if not line.startswith('gitdir: '):
+                return None
+            return os.path.join(path, line[8:])
+        path, extra = os.path.split(path)
+        if not extra:
+            return None
+
+
+def common_dir(git_dir):
+    """Return the directory holding the refs and configuration shared by
+    all the worktrees of git_dir."""
+    commondir = os.path.join(git_dir, 'commondir')
+    if not os.path.isfile(commondir):
+        return git_dir
+    fd = __builtin__.open(commondir)
+    try:
+        return os.path.join(git_dir, fd.read().strip())
+    finally:
+        fd.close()
+
+
+def parse_config_value(text):
+    value = []
+    pending = ''                        # whitespace kept only if followed
+    quoted = False
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c == '\\' and i + 1 < len(text):
+            i += 1
+            value.append(pending + config_escapes.get(text[i], text[i]))
+            pending = ''
+        elif c == '"':
+            quoted = not quoted
+        elif not quoted and c in '#;':
+            break
+        elif not quoted and c in ' \t':
+            pending += c
+        else:
+            value.append(pending + c)
+            pending = ''
+        i += 1
+    return ''.join(value)
+
+
+def parse_config(data, config):
+    """Add the settings in the text of a configuration file to config, a
+    dict keyed the way `git config --list' shows them.  Returns False if
+    the file includes others, which is left to Git."""
+    section = None
+    data = data.replace('\\\r\n', '').replace('\\\n', '')
+    for line in data.splitlines():
+        line = line.strip()
+        if not line or line[0] in '#;':
+            continue
+        if line[0] == '[':
+            match = config_section_pat.match(line)
+            if not match:
+                return False
+            section = match.group(1).lower()
+            if match.group(3) is not None:
+                section += '.' + re.sub(r'\\(.)', r'\1', match.group(3))
+            if section == 'include' or section.startswith('includeif.'):
+                return False
+            line = line[match.end():].strip()
+            if not line or line[0] in '#;':
+                continue
+        match = config_key_pat.match(line)
+        if not match or section is None:
+            return False
+        if match.group(2) is None:
+            value = 'true'
+        else:
+            value = parse_config_value(match.group(3))
+        config['%s.%s' % (section, match.group(1).lower())] = \
+            unicode(value, "utf-8")
+    return True
+
+
+def find_git():
+    """Return the path of the git executable that commands run from here
+    would use, or None if it is not on the PATH."""
+    for directory in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        path = os.path.join(directory or os.curdir, 'git')
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+    return None
+
+
+system_config_paths = {}         # the answer of each git executable
+
+def system_config_path():
+    """Return the name of Git's system-wide configuration file, or None if
+    Git will not say.  This is $(prefix)/etc/gitconfig for the prefix Git
+    was built with, which only Git knows; from Git 2.42 on, `git var
+    GIT_CONFIG_SYSTEM' gives it.  Each git executable is asked only once."""
+    executable = find_git()
+    if executable is None:
+        return None
+    if not executable in system_config_paths:
+        path = git('var', 'GIT_CONFIG_SYSTEM', ignore_errors=True)
+        system_config_paths[executable] = path and os.path.abspath(path)
+    return system_config_paths[executable] or None
+
+
+def read_config(repository=None):
+    """Return every configuration setting that applies to the repository,
+    as a dict, much as `git config --list' would give them."""
+    git_dir = find_git_dir(repository)
+    if git_dir:
+        git_dir = common_dir(git_dir)
+    understood = git_dir is not None and os.name != 'nt'
+    for name in config_env:
+        if name in os.environ:
+            understood = False
+
+    paths = []
+    if understood and not 'GIT_CONFIG_NOSYSTEM' in os.environ:
+        path = system_config_path()
+        if path is None:
+            understood = False
+        else:
+            paths.append(path)
+    home = os.path.expanduser('~')
+    paths.append(os.path.join(os.environ.get('XDG_CONFIG_HOME') or
+                              os.path.join(home, '.config'), 'git', 'config'))
+    paths.append(os.path.join(home, '.gitconfig'))
+    if git_dir:
+        paths.append(os.path.join(git_dir, 'config'))
+
+    config = {}
+    for path in paths:
+        if not understood:
+            break
+        if os.path.isfile(path):
+            try:
+                fd = __builtin__.open(path)
+                try:
+                    understood = parse_config(fd.read(), config)
+                finally:
+                    fd.close()
+            except IOError:
+                understood = False
+    if understood and config.get('extensions.worktreeconfig') != 'true':
+        return config
+
+    config = {}
+    kwargs = {'ignore_errors': True, 'keep_newline': True}
+    if repository:
+        kwargs['repository'] = repository
+    for entry in split(apply(git, ('config', '-z', '--list'), kwargs), '\0'):
+        if entry:
+            key, value = (entry.split('\n', 1) + [u'true'])[:2]
+            config[key] = value
+    return config
+
+
+def read_ref(ref, repository=None):
+    """Return the name of the object a full ref such as refs/heads/master
+    points to, or None if there is no such ref."""
+    git_dir = find_git_dir(repository)
+    if git_dir and not os.path.isdir(git_dir):
+        git_dir = None                  # let git() create it
+    if git_dir:
+        git_dir = common_dir(git_dir)
+        if os.path.isdir(os.path.join(git_dir, 'reftable')):
+            git_dir = None              # a ref store we can't read
+    if git_dir:
+        path = os.path.join(git_dir, ref)
+        if os.path.isfile(path):
+            fd = __builtin__.open(path)
+            try:
+                name = fd.read().strip()
+            finally:
+                fd.close()
+            if len(name) == 40:
+                return unicode(name)
+        elif not os.path.exists(path):
+            packed = os.path.join(git_dir, 'packed-refs')
+            if not os.path.isfile(packed):
+                return None
+            fd = __builtin__.open(packed)
+            try:
+                for line in fd:
+                    if line.rstrip('\n')[41:] == ref:
+                        return unicode(line[:40])
+            finally:
+                fd.close()
+            return None
+
+    kwargs = {'ignore_errors': True}
+    if repository:
+        kwargs['repository'] = repository
+    return apply(git, ('rev-parse', '--verify', '-q', ref), kwargs) or None
+
+
+######################################################################
+
+
+class gitbatch:
+    """Keeps a single `git cat-file --batch' process alive for a repository.
+    Object names are streamed to it on stdin, and each object comes back as a
+    header line giving its type and size, followed by exactly that many bytes
+    of content.  This avoids forking one process per object read."""
+
+    # Requests are written in chunks of this size before their responses are
+    # read back, so that neither side can block on a full pipe.
+    chunk_size = 1000
+
+    def __init__(self, repository=None):
+        self.repository = repository
+        self.proc = None
+
+    def start(self):
+        if verbose:
+            print "Command: git cat-file --batch"
+
+        self.proc = Popen(('git', 'cat-file', '--batch'),
+                          env=git_environ(self.repository),
+                          bufsize=-1, stdin=PIPE, stdout=PIPE)
+
+    def read_object(self, name):
+        header = self.proc.stdout.readline()
+        if not header:
+            raise GitError('cat-file', ('--batch',), {},
+                           'Unexpected end of output reading %s' % name)
+        fields = split(header[:-1], ' ')
+        if len(fields) != 3:
+            raise GitError('cat-file', ('--batch',), {},
+                           'Object %s is %s' % (name, fields[-1]))
+        size = int(fields[2])
+        data = self.proc.stdout.read(size)
+        self.proc.stdout.read(1)        # skip the trailing newline
+        return (fields[1], data)
+
+    def get_objects(self, names):
+        """Return a list of (type, data) pairs for the given object names,
+        fetching them all through one exchange with the batch process."""
+        if self.proc is None:
+            self.start()
+        if hooks:
+            start = time.time()
+            sent = 0
+
+        objects = []
+        for i in range(0, len(names), self.chunk_size):
+            chunk = names[i:i + self.chunk_size]
+            for name in chunk:
+                if isinstance(name, unicode):
+                    name = name.encode("utf-8")
+                self.proc.stdin.write(name + '\n')
+                if hooks:
+                    sent += len(name) + 1
+            self.proc.stdin.flush()
+            try:
+                for name in chunk:
+                    objects.append(self.read_object(name))
+            except GitError:
+                self.close()            # the stream is out of step now
+                raise
+
+        if hooks:
+            notify('git', 'cat-file --batch', time.time() - start, sent,
+                   sum([len(data) for kind, data in objects]), len(names))
+        return objects
+
+    def get_object(self, name):
+        return self.get_objects([name])[0]
+
+    def close(self):
+        if self.proc is not None:
+            self.proc.stdin.close()
+            self.proc.stdout.close()
+            self.proc.wait()
+            self.proc = None
+
+
+class gitimport:
+    """Writes blobs, trees and a commit through a single `git fast-import'
+    session.  Objects are identified by marks while the stream is being
+    written; the name of the commit is asked for afterwards with `get-mark',
+    whose answer comes back on the process's stdout.
+
+    The commit is made on a scratch ref, which is deleted again before the
+    session ends.  Moving the real branch is left to gitshelve.update_head, so
+    that it keeps its compare-and-swap semantics."""
+
+    scratch_ref = 'refs/gitshelve/import'
+
+    def __init__(self, repository=None):
+        self.repository = repository
+        self.proc = None
+        self.last_mark = 0
+        self.started = time.time()
+        self.sent = 0
+
+        if verbose:
+            print "Command: git fast-import"
+
+        self.proc = Popen(('git', 'fast-import', '--quiet',
+                           '--date-format=now'),
+                          env=git_environ(repository),
+                          bufsize=-1, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+
+    def fail(self, message=None):
+        self.proc.stdin.close()
+        err = self.proc.stderr.read()
+        self.proc.wait()
+        raise GitError('fast-import', (), {}, message or err)
+
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.sent += len(data)
+        try:
+            self.proc.stdin.write(data)
+        except IOError:
+            self.fail()
+
+    def write_data(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        self.write('data %d\n' % len(data))
+        self.write(data)
+        self.write('\n')
+
+    def next_mark(self):
+        self.last_mark += 1
+        return self.last_mark
+
+    def blob(self, data):
+        mark = self.next_mark()
+        self.write('blob\nmark :%d\n' % mark)
+        self.write_data(data)
+        return mark
+
+    def commit(self, author, committer, comment, parent, entries,
+               merges=()):
+        """Write a commit whose tree holds exactly the given `M' entries.
+        Any commits in merges become further parents after parent."""
+        mark = self.next_mark()
+        self.write('commit %s\nmark :%d\n' % (self.scratch_ref, mark))
+        self.write('author %s now\ncommitter %s now\n' % (author, committer))
+        self.write_data(comment)
+        if parent:
+            self.write('from %s\n' % parent)
+        for merge in merges:
+            self.write('merge %s\n' % merge)
+        self.write('deleteall\n')
+        for entry in entries:
+            self.write(entry)
+            self.write('\n')
+        self.write('\n')
+        return mark
+
+    def query(self, command):
+        self.write(command + '\n')
+        try:
+            self.proc.stdin.flush()
+        except IOError:
+            self.fail()
+        response = self.proc.stdout.readline()
+        if not response:
+            self.fail()
+        return response[:-1]
+
+    def get_mark(self, mark):
+        return self.query('get-mark :%d' % mark)
+
+    def close(self):
+        self.write('reset %s\n\ndone\n' % self.scratch_ref)
+        self.proc.stdin.close()
+        err = self.proc.stderr.read()
+        self.proc.stdout.close()
+        if self.proc.wait() != 0:
+            raise GitError('fast-import', (), {}, err)
+        if hooks:
+            notify('git', 'fast-import', time.time() - self.started,
+                   self.sent, 0, self.last_mark)
+
+    def abort(self):
+        """Stop a session that has not been closed, throwing away whatever
+        it was sent.  Does nothing once the session has ended."""
+        if self.proc.returncode is not None:
+            return
+        self.proc.kill()
+        self.proc.wait()
+        for pipe in (self.proc.stdin, self.proc.stdout, self.proc.stderr):
+            try:
+                pipe.close()
+            except IOError:
+                pass
+
+
+class gitbook(object):
     """Abstracts a reference to a data file within a Git repository.  It also
-    maintains knowledge of whether the object has been modified or not."""
+    maintains knowledge of whether the object has been modified or not.
+
+    Since a shelf may hold a great many books, they keep their attributes in
+    slots rather than in a dictionary of their own (subclasses should declare
+    __slots__ too, if only an empty one), and the name of the blob is kept as
+    20 bytes, shared between all books holding the same blob."""
+    __slots__ = ('shelf', 'path', 'sha', 'data', 'dirty')
+
     def __init__(self, shelf, path, name=None):
         self.shelf = shelf
         self.path = path
@@ -150,6 +736,19 @@ class gitbook:
         self.data = None
         self.dirty = False
 
+    def get_name(self):
+        if self.sha is None:
+            return None
+        return hexlify(self.sha)
+
+    def set_name(self, name):
+        if name is None:
+            self.sha = None
+        else:
+            self.sha = intern(unhexlify(str(name)))
+
+    name = property(get_name, set_name)
+
     def __repr__(self):
         return '<gitshelve.gitbook %s %s %s>' % \
                 (self.path, self.name, self.dirty)
@@ -157,34 +756,80 @@ class gitbook:
     def get_data(self):
         if self.data is None:
             assert self.name is not None
-            self.data = self.deserialize_data(self.shelf.get_blob(self.name))
+            self.data = self.complete_data(
+                self.deserialize_data(self.shelf.get_blob(self.name)))
         return self.data
 
+    def get_partial_data(self, fields):
+        """Return the data with only the named fields decoded, if the book
+        type knows how.  The result is not kept, since it is incomplete,
+        unless the whole of the data has been read already."""
+        if self.data is not None:
+            return self.data
+        assert self.name is not None
+        return self.deserialize_partial_data(self.shelf.get_blob(self.name),
+                                             fields)
+
     def set_data(self, data):
         if data != self.data:
             self.name = None
             self.data = data
             self.dirty = True
+            if self.shelf is not None:
+                self.shelf.dirty_paths.add(self.path)
 
     def serialize_data(self, data):
         return data
 
     def deserialize_data(self, data):
+        """Turn the contents of a blob into the book's data.  This may rely
+        on nothing but the book's path, since a shelf loading many books at
+        once may call it in another process, on a book with no shelf."""
         return data
 
+    def complete_data(self, data):
+        """Finish off freshly deserialized data.  This always runs in the
+        shelf's own process, where the rest of the shelf can be consulted."""
+        return data
+
+    def deserialize_partial_data(self, data, fields):
+        return self.deserialize_data(data)
+
     def change_comment(self):
         return None
 
     def __getstate__(self):
-        odict = self.__dict__.copy()  # copy the dict since we change it
-        del odict['dirty']            # remove dirty flag
+        odict = {'shelf': self.shelf, 'path': self.path, 'sha': self.sha,
+                 'data': self.data}   # leave out the dirty flag
+        if hasattr(self, '__dict__'):
+            odict.update(self.__dict__)
         return odict
 
     def __setstate__(self, ndict):
-        self.__dict__.update(ndict)   # update attributes
+        for key, value in ndict.items():
+            setattr(self, key, value)
+        if self.sha is not None:
+            self.sha = intern(self.sha)
         self.dirty = False
 
 
+def book_of(node):
+    """Return the book held by a node of a shelf's tree, or None if the node
+    is a tree itself."""
+    if isinstance(node, gitbook):
+        return node
+    if len(node) == 1 and '__book__' in node:
+        return node['__book__']
+    return None
+
+
+def deserialize_books(task):
+    """Run in a worker process by gitshelve.deserialize_in_parallel."""
+    book_type, items = task
+    return [book_type(None, path).deserialize_data(blob)
+            for path, blob in items]
+
+
 class gitshelve(dict):
     """This class implements a Python "shelf" using a branch within a Git
     repository.  There is no "writeback" argument, meaning changes are only
@@ -192,57 +837,150 @@ class gitshelve(dict):
 
     This implementation uses a dictionary of gitbook objects, since we don't
     really want to use Pickling within a Git repository (it's not friendly to
-    other Git users, nor does it support merging)."""
+    other Git users, nor does it support merging).
+
+    When opened with lazy=True, the branch is not listed in full up front.
+    Instead, a tree that hasn't been looked at yet is represented by a
+    dictionary holding only its '__root__' name and a '__lazy__' entry giving
+    its path, and its entries are read through the batch process the first
+    time anything reaches into it.  Untouched trees are never read at all, and
+    make_tree simply reuses their names.
+
+    A book sits in its tree in a dictionary of its own, under '__book__'.
+    When opened with compact=True, which saves much of the memory taken by
+    large shelves, the book sits in its tree directly instead, and the names
+    of entries and trees are kept as interned byte strings rather than as
+    unicode.  get_tree still returns a '__book__' dictionary for a book, to
+    look at; get_book and set_book work with either layout.
+
+    When opened with optimistic=True, a shelf whose commit loses the race
+    for its branch to another writer catches up and tries again, rather
+    than raising HeadMoved; see commit.  Books both writers changed are
+    merged by the function given as resolve, as merge does, which is not
+    pickled with the shelf.
+
+    The paths of books set or deleted since the last commit are kept in
+    dirty_paths.  Committing only descends into the trees above those paths;
+    every other tree keeps the name it had, so the cost of a commit follows
+    the size of the change rather than that of the branch."""
     ls_tree_pat = \
             re.compile('((\d{6}) (tree|blob)) ([0-9a-f]{40})\t(start|(.+))$')
 
     head = None
     dirty = False
     objects = None
+    batch = None
+    refreshed = None
+    compact = False
+    optimistic = False
+    resolve = None
+    retries = 10
+    retry_delay = 0.01
 
     def __init__(self, branch='master', repository=None,
-                 keep_history=True, book_type=gitbook):
+                 keep_history=True, book_type=gitbook, fast_import=True,
+                 lazy=False, jobs=1, compact=None, optimistic=None,
+                 resolve=None):
+        if compact is not None:
+            self.compact = compact
+        if optimistic is not None:
+            self.optimistic = optimistic
+        if resolve is not None:
+            self.resolve = resolve
         self.branch = branch
         self.repository = repository
         self.keep_history = keep_history
         self.book_type = book_type
+        self.fast_import = fast_import
+        self.lazy = lazy
+        self.jobs = jobs
+        self.idents = None
         self.init_data()
         dict.__init__(self)
 
     def init_data(self):
         self.head = None
         self.dirty = False
+        self.dirty_paths = set()
+        self.rebased = []
         self.objects = {}
 
+    def compact_name(self, name):
+        """Return the form in which a name or a tree's name is kept."""
+        if self.compact:
+            try:
+                return intern(str(name))
+            except UnicodeError:
+                pass
+        return name
+
+    def make_leaf(self, book):
+        """Return what holds book in its tree."""
+        if self.compact:
+            return book
+        return {'__book__': book}
+
+    def dirty_trees(self):
+        """Return the paths of the trees holding anything in dirty_paths,
+        including '' for the top-level tree."""
+        trees = set([''])
+        for path in self.dirty_paths:
+            parts = split(path, os.sep)
+            for i in range(1, len(parts)):
+                trees.add(join(parts[:i], '/'))
+        return trees
+
     def git(self, *args, **kwargs):
         if self.repository:
             kwargs['repository'] = self.repository
         return apply(git, args, kwargs)
 
     def current_head(self):
-        x = self.git('rev-parse', self.branch)
+        x = read_ref('refs/heads/%s' % self.branch, self.repository)
+        if not x:
+            raise GitError('rev-parse', (self.branch,), {},
+                           'No branch named %s' % self.branch)
         if len(x) != 40:
             raise ValueError("rev-parse went insane: %s" % x)
         return x
 
     def update_head(self, new_head):
-        if self.head:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head,
-                     self.head)
-        else:
-            self.git('update-ref', 'refs/heads/%s' % self.branch, new_head)
+        """Point the branch at new_head, provided it still points where it
+        did when the shelf last looked; if not, HeadMoved is raised."""
+        ref = 'refs/heads/%s' % self.branch
+        try:
+            if self.head:
+                self.git('update-ref', ref, new_head, self.head)
+            else:
+                self.git('update-ref', ref, new_head, '')
+        except GitError, e:
+            # The ref may also just be locked by another writer
+            if read_ref(ref, self.repository) == self.head and \
+               not 'lock' in (e.stderr or ''):
+                raise
+            raise HeadMoved('update-ref', (ref, new_head, self.head), {},
+                            e.stderr)
         self.head = new_head
 
-    def read_repository(self):
+    def read_repository(self, head=None):
         self.init_data()
-        try:
-            self.head = self.current_head()
-        except:
-            self.head = None
+        if head is None:
+            try:
+                head = self.current_head()
+            except:
+                head = None
+        self.head = head
 
         if not self.head:
             return
 
+        if self.lazy:
+            kind, data = self.get_batch().get_object(self.head)
+            assert kind == 'commit' and data[:5] == 'tree '
+            self.objects = {'__root__': self.compact_name(unicode(data[5:45])),
+                            '__lazy__': ''}
+            return
+
         ls_tree = split(self.git('ls-tree', '-r', '-t', '-z', self.head),
                         '\0')
         for line in ls_tree:
@@ -253,64 +991,340 @@ class gitshelve(dict):
 
             treep = match.group(1) == "040000 tree"
             perm = match.group(2)
-            name = match.group(4)
+            name = self.compact_name(match.group(4))
             path = match.group(5)
 
-            parts = split(path, os.sep)
+            parts = map(self.compact_name, split(path, os.sep))
             d = self.objects
-            for part in parts:
+            for part in parts[:-1]:
                 if not part in d:
                     d[part] = {}
                 d = d[part]
 
             if treep:
                 if perm == '040000':
-                    d['__root__'] = name
+                    d.setdefault(parts[-1], {})['__root__'] = name
                 else:
                     raise GitError('read_repository', [], {},
                            'Invalid mode for %s : 040000 required, %s found' \
                                    % (path, perm))
             else:
                 if perm == '100644':
-                    d['__book__'] = self.book_type(self, path, name)
+                    d[parts[-1]] = self.make_leaf(self.book_type(self, path,
+                                                                 name))
                 else:
                     raise GitError('read_repository', [], {},
                            'Invalid mode for %s : 100644 required, %s found' \
                                 % (path, perm))
 
+    def load_trees(self, trees):
+        """Read the entries of every lazily loaded tree in the given list that
+        hasn't been read yet, using a single round trip to the batch
+        process."""
+        trees = [tree for tree in trees if '__lazy__' in tree]
+        if not trees:
+            return
+        objects = self.get_batch().get_objects([tree['__root__']
+                                                for tree in trees])
+        for tree, (kind, data) in zip(trees, objects):
+            assert kind == 'tree'
+            prefix = tree['__lazy__']
+            del tree['__lazy__']
+            if prefix:
+                prefix += '/'
+
+            for perm, name, sha in parse_tree(data):
+                name = self.compact_name(name)
+                path = prefix + name
+                if perm == '40000':
+                    tree[name] = {'__root__': self.compact_name(sha),
+                                  '__lazy__': path}
+                elif perm == '100644':
+                    tree[name] = self.make_leaf(self.book_type(self, path,
+                                                               sha))
+                else:
+                    raise GitError('read_repository', [], {},
+                                   'Invalid mode for %s : %s found' %
+                                   (path, perm))
+
+    def load_tree(self, tree):
+        if '__lazy__' in tree:
+            self.load_trees([tree])
+
+    def refresh(self, head=None):
+        """Bring the shelf up to date with its branch, which may have moved
+        since the shelf was read, or with the commit head if given.  Rather
+        than reading the whole branch again, only the entries reported by a
+        single `git diff-tree' between the old and the new head are updated.
+
+        Returns a list of (status, path) pairs for the books that were added
+        ('A'), modified ('M') or deleted ('D'), or None if the shelf had to
+        be read again from scratch."""
+        if head is None:
+            try:
+                head = self.current_head()
+            except:
+                head = None
+
+        if head == self.head:
+            return []
+        if not head or not self.head or self.dirty:
+            self.read_repository(head)
+            return None
+
+        try:
+            diff = self.git('diff-tree', '-r', '-t', '-z', self.head, head)
+        except GitError:
+            # The old head may be gone, after a forced update and a gc
+            self.read_repository(head)
+            return None
+
+        changes = []
+        fields = split(diff, '\0')
+        for i in range(0, len(fields) - 1, 2):
+            old_mode, mode, old_sha, sha, status = split(fields[i][1:], ' ')
+            path = fields[i + 1]
+            treep = mode == '040000' or (status == 'D' and
+                                         old_mode == '040000')
+            if not treep:
+                if status == 'D' or mode == '100644':
+                    changes.append((status[0], path))
+                else:
+                    raise GitError('refresh', [], {},
+                           'Invalid mode for %s : 100644 required, %s found' \
+                                % (path, mode))
+
+            # Walk down to the tree holding this entry.  If that tree hasn't
+            # been read yet, or has gone away, there is nothing to update.
+            parts = map(self.compact_name, split(path, '/'))
+            sha = self.compact_name(sha)
+            d = self.objects
+            for part in parts[:-1]:
+                if '__lazy__' in d or not part in d:
+                    d = None
+                    break
+                d = d[part]
+                if not isinstance(d, dict):
+                    d = None
+                    break
+            if d is None or '__lazy__' in d:
+                continue
+
+            leaf = parts[-1]
+            if status == 'D':
+                if leaf in d:
+                    del d[leaf]
+            elif treep:
+                if leaf in d and book_of(d[leaf]) is None:
+                    d[leaf]['__root__'] = sha
+                elif self.lazy:
+                    d[leaf] = {'__root__': sha, '__lazy__': path}
+                else:
+                    d[leaf] = {'__root__': sha}
+            else:
+                d[leaf] = self.make_leaf(self.book_type(self, path, sha))
+
+        kind, data = self.get_batch().get_object(head)
+        self.objects['__root__'] = self.compact_name(unicode(data[5:45]))
+        self.head = head
+        return changes
+
     def open(cls, branch='master', repository=None,
-             keep_history=True, book_type=gitbook):
-        shelf = gitshelve(branch, repository, keep_history, book_type)
+             keep_history=True, book_type=gitbook, fast_import=True,
+             lazy=False, jobs=1, compact=None, optimistic=None,
+             resolve=None):
+        shelf = gitshelve(branch, repository, keep_history, book_type,
+                          fast_import, lazy, jobs, compact, optimistic,
+                          resolve)
         shelf.read_repository()
         return shelf
 
     open = classmethod(open)
 
+    def get_batch(self):
+        if self.batch is None:
+            self.batch = gitbatch(self.repository)
+        return self.batch
+
+    def close_batch(self):
+        if self.batch is not None:
+            self.batch.close()
+            self.batch = None
+
+    def get_blobs(self, names):
+        """Read many blobs at once, returning their contents in the same order
+        as the given names."""
+        blobs = []
+        for kind, data in self.get_batch().get_objects(names):
+            if kind != 'blob':
+                raise GitError('cat-file', ('--batch',), {},
+                               'Expected a blob, found a %s' % kind)
+            blobs.append(unicode(data, "utf-8"))
+        return blobs
+
     def get_blob(self, name):
-        return self.git('cat-file', 'blob', name, keep_newline=True)
+        return self.get_blobs([name])[0]
+
+    def load_books(self, books):
+        """Fill in the data of every book that has not been read yet, using a
+        single round trip to the batch process."""
+        books = [book for book in books
+                 if book.data is None and book.name is not None]
+        if not books:
+            return
+        blobs = self.get_blobs([book.name for book in books])
+        if self.jobs != 1:
+            datas = self.deserialize_in_parallel(books, blobs)
+        else:
+            datas = [book.deserialize_data(blob)
+                     for book, blob in zip(books, blobs)]
+        for book, data in zip(books, datas):
+            book.data = book.complete_data(data)
+
+    def deserialize_in_parallel(self, books, blobs):
+        """Deserialize the given blobs on behalf of their books using a pool
+        of worker processes, one per core unless jobs says otherwise.  The
+        work is split up by the books' top-level (fan-out) directories.  The
+        results come back in the order of the books given."""
+        groups = {}
+        for index in range(len(books)):
+            top = split(books[index].path, '/')[0]
+            groups.setdefault(top, []).append(index)
+        if len(groups) < 2:
+            return [book.deserialize_data(blob)
+                    for book, blob in zip(books, blobs)]
+
+        import multiprocessing          # only needed here
+
+        tasks = [(books[group[0]].__class__,
+                  [(books[index].path, blobs[index]) for index in group])
+                 for group in groups.values()]
+        pool = multiprocessing.Pool(self.jobs or None)
+        try:
+            results = pool.map(deserialize_books, tasks)
+        finally:
+            pool.terminate()
+
+        datas = [None] * len(books)
+        for group, result in zip(groups.values(), results):
+            for index, data in zip(group, result):
+                datas[index] = data
+        return datas
+
+    def load_partial_books(self, books, fields):
+        """Return the data of the given books with only the named fields
+        decoded, as gitbook.get_partial_data does, reading whatever is still
+        needed in a single round trip to the batch process."""
+        unread = [book for book in books
+                  if book.data is None and book.name is not None]
+        blobs = {}
+        if unread:
+            blobs = dict(zip([book.name for book in unread],
+                             self.get_blobs([book.name for book in unread])))
+        results = []
+        for book in books:
+            if book.data is None and book.name is not None:
+                results.append(book.deserialize_partial_data(blobs[book.name],
+                                                             fields))
+            else:
+                results.append(book.data)
+        return results
+
+    def iterblobs(self, chunk_size=1000, select=None):
+        """Yield the path and the contents of every book in the shelf, or
+        only of those whose paths select returns true for.  The blobs are
+        read from Git chunk_size at a time, and are not kept, so that even a
+        shelf whose data would not fit in memory can be gone through.  Books
+        not committed yet have their data serialized."""
+        chunk = []
+        for item in self.iteritems():
+            if select is not None and not select(item[0]):
+                continue
+            chunk.append(item)
+            if len(chunk) >= chunk_size:
+                for result in self.read_chunk(chunk):
+                    yield result
+                chunk = []
+        for result in self.read_chunk(chunk):
+            yield result
+
+    def read_chunk(self, items):
+        named = [book.name for path, book in items if book.name is not None]
+        blobs = iter(self.get_blobs(named))
+        for path, book in items:
+            if book.name is not None:
+                yield (path, blobs.next())
+            else:
+                data = book.serialize_data(book.data)
+                if isinstance(data, str):
+                    data = unicode(data, "utf-8")
+                yield (path, data)
+
+    def import_blobs(self, items):
+        """Store the serialized data of each (path, data) pair given, where
+        the pairs may come from an iterator.  The blobs are streamed through
+        a single fast-import session as they come, rather than being held in
+        memory, and anything identical to what the shelf holds already is
+        skipped.  Returns the paths that changed; they are recorded by the
+        next commit."""
+        importer = None
+        written = []
+        try:
+            for path, data in items:
+                name = self.hash_blob(data)
+                try:
+                    if self.get_book(path).name == name:
+                        continue
+                except KeyError:
+                    pass
+                if importer is None:
+                    importer = gitimport(self.repository)
+                importer.blob(data)
+                written.append((path, name))
+            if importer is not None:
+                importer.close()
+        finally:
+            if importer is not None:
+                importer.abort()
+
+        # Only now that fast-import has written the blobs do books name them
+        changed = []
+        for path, name in written:
+            self.set_book(path, self.book_type(self, path, name))
+            self.dirty = True
+            self.dirty_paths.add(path)
+            changed.append(path)
+        return changed
 
     def hash_blob(self, data):
-        return self.git('hash-object', '--stdin', input=data)
+        return hash_object('blob', data)
 
     def make_blob(self, data):
         return self.git('hash-object', '-w', '--stdin', input=data)
 
-    def make_tree(self, objects, comment_accumulator=None):
+    def make_tree(self, objects, comment_accumulator=None, dirty_trees=None,
+                  prefix=''):
+        if '__lazy__' in objects:
+            return objects['__root__']  # never loaded, so never changed
+        if dirty_trees is None:
+            dirty_trees = self.dirty_trees()
+
         buf = StringIO()
+        entries = []
 
-        root = None
-        if '__root__' in objects:
-            root = objects['__root__']
+        old_root = objects.get('__root__')
+        root = old_root
+        if prefix[:-1] in dirty_trees:
+            root = None                 # something in here was deleted
 
         for path in objects.keys():
             if path == '__root__':
                 continue
 
             obj = objects[path]
-            assert isinstance(obj, dict)
+            book = book_of(obj)
 
-            if len(obj.keys()) == 1 and '__book__' in obj:
-                book = obj['__book__']
+            if book is not None:
                 if book.dirty:
                     if comment_accumulator:
                         comment = book.change_comment()
@@ -322,41 +1336,350 @@ class gitshelve(dict):
                     root = None
 
                 buf.write("100644 blob %s\t%s\0" % (book.name, path))
+                entries.append(('100644', path, book.name))
 
             else:
-                tree_root = None
-                if '__root__' in obj:
-                    tree_root = obj['__root__']
-
-                tree_name = self.make_tree(obj, comment_accumulator)
+                tree_root = obj.get('__root__')
+                if tree_root and not (prefix + path) in dirty_trees:
+                    tree_name = tree_root   # nothing changed in there
+                else:
+                    tree_name = self.make_tree(obj, comment_accumulator,
+                                               dirty_trees,
+                                               prefix + path + '/')
                 if tree_name != tree_root:
                     root = None
 
                 buf.write("040000 tree %s\t%s\0" % (tree_name, path))
+                entries.append(('40000', path, tree_name))
 
         if root is None:
-            name = self.git('mktree', '-z', input=buf.getvalue())
+            # Only write the tree if its contents really differ from what
+            # was there before; books may have been set to the same data.
+            name = hash_tree(entries)
+            if name != old_root:
+                name = self.git('mktree', '-z', input=buf.getvalue())
             objects['__root__'] = name
             return name
         else:
             return root
 
-    def make_commit(self, tree_name, comment):
+    def make_commit(self, tree_name, comment, merges=()):
         if not comment:
             comment = ""
+        args = ['commit-tree', tree_name]
         if self.head and self.keep_history:
-            name = self.git('commit-tree', tree_name, '-p', self.head,
-                            input=comment)
-        else:
-            name = self.git('commit-tree', tree_name, input=comment)
+            args.extend(['-p', self.head])
+        for merge in merges:
+            args.extend(['-p', merge])
+        name = self.git(input=comment, *args)
 
         self.update_head(name)
         return name
 
-    def commit(self, comment=None):
-        if not self.dirty:
+    def get_idents(self):
+        """Return the author and committer identities for new commits, minus
+        the timestamps, which fast-import fills in itself."""
+        if self.idents is None:
+            config = read_config(self.repository)
+            idents = []
+            for role in ('author', 'committer'):
+                # The same order of precedence as Git's own
+                name = (os.environ.get('GIT_%s_NAME' % role.upper()) or
+                        config.get(role + '.name') or
+                        config.get('user.name'))
+                email = (os.environ.get('GIT_%s_EMAIL' % role.upper()) or
+                         config.get(role + '.email') or
+                         config.get('user.email') or
+                         os.environ.get('EMAIL'))
+                if name and email:
+                    idents.append(u'%s <%s>' % (name, email))
+                else:
+                    ident = self.git('var', 'GIT_%s_IDENT' % role.upper())
+                    idents.append(ident.rsplit(' ', 2)[0])
+            self.idents = tuple(idents)
+        return self.idents
+
+    def import_tree(self, importer, objects, prefix, pending,
+                    comment_accumulator=None, dirty_trees=None):
+        """The fast-import counterpart of make_tree.  Dirty books are written
+        as blobs, and the `M' entries describing this tree are returned along
+        with its name, and whether it differs from the tree that was there
+        before.  Names are computed locally, so nothing needs to be read back
+        from fast-import except the commit.
+
+        The new names of books and trees are not given to them here, but
+        added to pending as (book or tree, name) pairs, for apply_names to
+        do once fast-import has written everything."""
+        if '__lazy__' in objects:
+            return (['M 040000 %s %s' % (objects['__root__'],
+                                         quote_path(prefix[:-1]))],
+                    objects['__root__'], False)
+        if dirty_trees is None:
+            dirty_trees = self.dirty_trees()
+
+        entries = []
+        tree = []
+
+        old_root = objects.get('__root__')
+        root = old_root
+        if prefix[:-1] in dirty_trees:
+            root = None                 # something in here was deleted
+
+        for path in objects.keys():
+            if path == '__root__':
+                continue
+
+            obj = objects[path]
+            book = book_of(obj)
+
+            if book is not None:
+                if book.dirty:
+                    if comment_accumulator:
+                        comment = book.change_comment()
+                        if comment:
+                            comment_accumulator.write(comment)
+
+                    data = book.serialize_data(book.data)
+                    blob = self.hash_blob(data)
+                    pending.append((book, blob))
+                    name = ':%d' % importer.blob(data)
+                    root = None
+                else:
+                    name = blob = book.name
+
+                entries.append('M 100644 %s %s' %
+                               (name, quote_path(prefix + path)))
+                tree.append(('100644', path, blob))
+
+            elif '__root__' in obj and not (prefix + path) in dirty_trees:
+                # Nothing changed in there
+                entries.append('M 040000 %s %s' %
+                               (obj['__root__'], quote_path(prefix + path)))
+                tree.append(('40000', path, obj['__root__']))
+
+            else:
+                tree_entries, tree_name, changed = \
+                    self.import_tree(importer, obj, prefix + path + '/',
+                                     pending, comment_accumulator,
+                                     dirty_trees)
+                if not tree_entries:
+                    # fast-import does not record empty directories
+                    pending.append((obj, None))
+                    root = None
+                    continue
+                if changed:
+                    root = None
+                    entries.extend(tree_entries)
+                else:
+                    entries.append('M 040000 %s %s' %
+                                   (tree_name, quote_path(prefix + path)))
+                tree.append(('40000', path, tree_name))
+
+        if root is None:
+            root = hash_tree(tree)
+            pending.append((objects, root))
+        return (entries, root, root != old_root)
+
+    def apply_names(self, pending):
+        """Give the books and trees in pending, as filled in by import_tree,
+        their new names."""
+        for target, name in pending:
+            if isinstance(target, dict):
+                if name is None:
+                    target.pop('__root__', None)
+                else:
+                    target['__root__'] = name
+            else:
+                target.name = name
+                target.dirty = False
+
+    def import_commit(self, comment=None, merges=()):
+        """Write every dirty book, the changed trees and the commit itself
+        through one fast-import session, returning the new commit name."""
+        author, committer = self.get_idents()
+        accumulator = None
+        if comment is None:
+            accumulator = StringIO()
+        pending = []
+
+        # Should anything fail, the shelf is left as it was, to be committed
+        # again from scratch
+        importer = gitimport(self.repository)
+        try:
+            entries = self.import_tree(importer, self.objects, '', pending,
+                                       accumulator)[0]
+            if accumulator:
+                comment = accumulator.getvalue()
+
+            parent = None
+            if self.head and self.keep_history:
+                parent = self.head
+
+            mark = importer.commit(author, committer, comment or "", parent,
+                                   entries, merges)
+            name = importer.get_mark(mark)
+            importer.close()
+        finally:
+            importer.abort()
+        self.apply_names(pending)
+
+        self.update_head(name)
+        return name
+
+    def commit(self, comment=None, merges=()):
+        """Commit what changed in the shelf, returning the new head.  Any
+        commits in merges become further parents of the new commit, which is
+        then made even if nothing changed.
+
+        If someone else moved the branch meanwhile, HeadMoved is raised, and
+        the shelf is left with its changes still to be committed.  Unless
+        the shelf is optimistic, that is: then it catches up with the branch,
+        puts its own changes back on top, and tries again, up to `retries'
+        times with a growing, randomized delay in between.  What the shelf
+        picked up from others on the way is listed in `rebased', as (status,
+        path) pairs like those returned by refresh, or is None if it had to
+        read the branch again from scratch."""
+        if not self.dirty and not merges:
             return self.head
 
+        self.rebased = []
+        paths = set(self.dirty_paths)
+        attempt = 0
+        while True:
+            start = time.time()
+            try:
+                name = self.write_commit(comment, merges)
+            except HeadMoved:
+                if not self.optimistic or attempt >= self.retries:
+                    self.dirty = True
+                    self.dirty_paths = paths
+                    raise
+                time.sleep(self.retry_delay * (2 ** attempt) *
+                           random.uniform(0.5, 1.5))
+                self.rebase(paths)
+                attempt += 1
+                if hooks:
+                    notify('commit', 'retry', time.time() - start)
+                continue
+            if hooks:
+                notify('commit', 'commit', time.time() - start, count=len(paths))
+            return name
+
+    def rebase(self, paths):
+        """Catch up with the branch after losing a race for it, and put back
+        the books at the given paths, which the shelf had changed or deleted,
+        so that the next commit records them on top of the new head.
+
+        Where the branch changed one of those paths as well, both versions
+        are merged by `resolve', as merge does, with the one at the shelf's
+        old head as the base.  If there is no resolve, or one of the books
+        is a file (see write_file), HeadMoved is raised instead, and the
+        shelf is left as it was."""
+        books = {}
+        for path in paths:
+            try:
+                books[path] = self.get_book(path)
+            except KeyError:
+                books[path] = None      # deleted
+
+        try:
+            head = self.current_head()
+        except GitError:
+            head = None
+        conflicts = self.rebase_conflicts(books, head)
+        unresolved = [path for path, base_sha, their_sha in conflicts
+                      if self.resolve is None or
+                      (books[path] is not None and books[path].data is None)]
+        if unresolved:
+            self.dirty = True
+            self.dirty_paths = set(paths)
+            raise HeadMoved('rebase', (head,), {},
+                            'Conflicting changes to %s' %
+                            join(sorted(unresolved), ', '))
+
+        merged = {}
+        if conflicts:
+            sides = [[sha and self.book_type(self, path, sha)
+                      for sha in (base_sha, their_sha)]
+                     for path, base_sha, their_sha in conflicts]
+            self.load_books([book for pair in sides for book in pair
+                             if book])
+            for (path, base_sha, their_sha), (base, theirs) in \
+                    zip(conflicts, sides):
+                ours = books[path]
+                merged[path] = (self.resolve(path, base and base.data,
+                                             ours and ours.data,
+                                             theirs and theirs.data),
+                                their_sha)
+
+        self.dirty = False
+        self.dirty_paths = set()
+        changes = self.refresh(head)
+        if changes is None or self.rebased is None:
+            self.rebased = None
+        else:
+            self.rebased.extend([change for change in changes
+                                 if not change[1] in paths])
+
+        for path, book in books.items():
+            if path in merged:
+                data, their_sha = merged[path]
+                if data is not None:
+                    self[path] = data
+                    change = (their_sha and 'M' or 'A', path)
+                elif their_sha:
+                    del self[path]
+                    change = ('D', path)
+                else:
+                    continue
+                if self.rebased is not None:
+                    self.rebased.append(change)
+            elif book is None:
+                try:
+                    del self[path]
+                except KeyError:
+                    pass
+            else:
+                if book.data is not None:
+                    book.dirty = True   # files were written as they are
+                self.set_book(path, book)
+        self.dirty = True
+        self.dirty_paths = set(paths)
+
+    def rebase_conflicts(self, books, head):
+        """Return (path, base_sha, their_sha) for each of the given books
+        that the commit head changed as well, since the shelf's own head."""
+        if not head or head == self.head:
+            return []
+        names = [head]
+        if self.head:
+            names.insert(0, self.head)
+        roots = [data[5:45] for kind, data in
+                 self.get_batch().get_objects(names)]
+        trees = {}
+        conflicts = []
+        for path, book in sorted(books.items()):
+            base_sha = None
+            if self.head:
+                base_sha = self.tree_entry(roots[0], path, trees)[1]
+            their_sha = self.tree_entry(roots[-1], path, trees)[1]
+            if their_sha == base_sha:
+                continue                # only we changed it
+            if book is None:
+                if their_sha is None:
+                    continue            # both deleted it
+            elif not book.dirty and book.name == their_sha:
+                continue                # both made the same change
+            conflicts.append((path, base_sha, their_sha))
+        return conflicts
+
+    def write_commit(self, comment=None, merges=()):
+        if self.fast_import:
+            name = self.import_commit(comment, merges)
+            self.dirty = False
+            self.dirty_paths = set()
+            return name
+
         accumulator = None
         if comment is None:
             accumulator = StringIO()
@@ -366,9 +1689,10 @@ class gitshelve(dict):
         tree = self.make_tree(self.objects, accumulator)
         if accumulator:
             comment = accumulator.getvalue()
-        name = self.make_commit(tree, comment)
+        name = self.make_commit(tree, comment, merges)
 
         self.dirty = False
+        self.dirty_paths = set()
         return name
 
     def sync(self):
@@ -378,9 +1702,236 @@ class gitshelve(dict):
         r = self.git('rev-list', '--parents', '--max-count=1', self.branch)
         return r.split()[1:]
 
+    def is_ancestor(self, old, new):
+        """Whether the commit old is reachable from the commit new."""
+        try:
+            return self.git('merge-base', old, new) == old
+        except GitError:
+            return False                # old may have been gc'd away
+
+    def read_tree(self, name, trees):
+        """Return the entries of a tree as a dict mapping names to (mode,
+        sha) pairs, keeping the trees read so far in the dict trees."""
+        entries = trees.get(name)
+        if entries is None:
+            kind, data = self.get_batch().get_object(name)
+            entries = {}
+            for mode, entry, sha in parse_tree(data):
+                entries[entry] = (mode, sha)
+            trees[name] = entries
+        return entries
+
+    def tree_entry(self, tree, path, trees):
+        """Return the (mode, sha) of the entry at path beneath tree, or
+        (None, None) if there is none."""
+        entry = ('40000', tree)
+        for part in split(path, '/'):
+            if entry[0] != '40000':
+                return (None, None)
+            entry = self.read_tree(entry[1], trees).get(part, (None, None))
+        return entry
+
+    def diff_trees(self, old, new, trees, prefix=''):
+        """Compare two trees, either of which may be None, without asking
+        Git.  Returns (status, path, old_sha, new_sha) for every blob added
+        ('A'), modified ('M') or deleted ('D') beneath them.  Subtrees with
+        the same name on both sides are not read at all."""
+        if old == new:
+            return []
+        old_entries = old and self.read_tree(old, trees) or {}
+        new_entries = new and self.read_tree(new, trees) or {}
+
+        changes = []
+        names = set(old_entries.keys())
+        names.update(new_entries.keys())
+        for name in sorted(names):
+            old_mode, old_sha = old_entries.get(name, (None, None))
+            mode, sha = new_entries.get(name, (None, None))
+            if old_sha == sha:
+                continue
+            path = prefix + name
+            if old_mode == '40000' or mode == '40000':
+                changes.extend(self.diff_trees(
+                    old_mode == '40000' and old_sha or None,
+                    mode == '40000' and sha or None, trees, path + '/'))
+            if old_mode and old_mode != '40000':
+                if mode and mode != '40000':
+                    changes.append(('M', path, old_sha, sha))
+                else:
+                    changes.append(('D', path, old_sha, None))
+            elif mode and mode != '40000':
+                changes.append(('A', path, None, sha))
+        return changes
+
+    def merge_trees(self, base, ours, theirs, trees, prefix=''):
+        """Three-way merge of trees by name, any of which may be None.
+        Returns (path, base_sha, our_sha, their_sha) for every blob that
+        theirs changed and ours does not hold already; a sha is None where
+        there is no blob.  Only the subtrees whose names differ between the
+        three sides are read, so the cost follows the number of entries that
+        diverged rather than the size of the trees."""
+        if ours == theirs or base == theirs:
+            return []
+        if base == ours:
+            # Only theirs changed anything beneath here
+            return [(path, old_sha, old_sha, sha) for status, path, old_sha, sha
+                    in self.diff_trees(ours, theirs, trees, prefix)]
+
+        sides = [tree and self.read_tree(tree, trees) or {}
+                 for tree in (base, ours, theirs)]
+        names = set()
+        for entries in sides:
+            names.update(entries.keys())
+
+        actions = []
+        for name in sorted(names):
+            entries = [entries.get(name, (None, None)) for entries in sides]
+            if entries[1] == entries[2] or entries[0] == entries[2]:
+                continue
+            path = prefix + name
+            subtrees = [mode == '40000' and sha or None
+                        for mode, sha in entries]
+            actions.extend(self.merge_trees(subtrees[0], subtrees[1],
+                                            subtrees[2], trees, path + '/'))
+            blobs = [mode and mode != '40000' and sha or None
+                     for mode, sha in entries]
+            if blobs[2] != blobs[0] and blobs[1] != blobs[2]:
+                actions.append((path,) + tuple(blobs))
+        return actions
+
+    def merge(self, theirs, resolve=None, comment=None):
+        """Merge the commit theirs into the branch, in memory and without a
+        work tree.  Whatever is not yet committed is committed first.
+
+        If either side already holds the other, the branch is left alone or
+        fast-forwarded.  Otherwise the trees of the merge base and of both
+        sides are compared by name with merge_trees.  Blobs that only theirs
+        changed are taken as they are; for those both sides changed,
+        resolve(path, base, ours, theirs) is given the deserialized data of
+        each side (None where there is none) and returns the merged data, or
+        None to delete the blob.  Without resolve, that raises a GitError.
+        The result is committed with theirs as a second parent.
+
+        Returns (status, path) pairs for the books that changed, as refresh
+        does, or None if the shelf had to be read again from scratch."""
+        self.sync()
+        if not self.head:
+            self.git('update-ref', 'refs/heads/%s' % self.branch, theirs)
+            self.read_repository()
+            return None
+        ours = self.head
+        base = self.git('merge-base', ours, theirs)
+        if base == theirs:
+            return []
+        if base == ours:
+            self.git('update-ref', 'refs/heads/%s' % self.branch, theirs,
+                     ours)
+            return self.refresh()
+
+        trees = {}
+        batch = self.get_batch()
+        base_tree, our_tree, their_tree = \
+            [data[5:45] for kind, data in
+             batch.get_objects([base, ours, theirs])]
+        actions = self.merge_trees(base_tree, our_tree, their_tree, trees)
+
+        conflicts = [action for action in actions if action[2] != action[1]]
+        if conflicts and resolve is None:
+            raise GitError('merge', (theirs,), {},
+                           'Conflicting changes to %s' %
+                           join([path for path, b, o, t in conflicts], ', '))
+
+        changes = []
+        for path, base_sha, our_sha, their_sha in actions:
+            if our_sha != base_sha:
+                continue
+            elif their_sha is None:
+                del self[path]
+                changes.append(('D', path))
+            else:
+                self.set_book(path, self.book_type(self, path, their_sha))
+                self.dirty_paths.add(path)
+                changes.append((our_sha and 'M' or 'A', path))
+
+        if conflicts:
+            books = [[sha and self.book_type(self, path, sha)
+                      for sha in (base_sha, our_sha, their_sha)]
+                     for path, base_sha, our_sha, their_sha in conflicts]
+            self.load_books([book for sides in books for book in sides
+                             if book])
+            for (path, b, our_sha, t), sides in zip(conflicts, books):
+                data = resolve(path, *[book and book.data for book in sides])
+                if data is not None:
+                    self[path] = data
+                    changes.append((our_sha and 'M' or 'A', path))
+                elif our_sha:
+                    del self[path]
+                    changes.append(('D', path))
+
+        self.dirty = True
+        self.commit(comment or "Merged %s\n" % theirs, [theirs])
+        return changes
+
+    def history(self, since=None, head=None):
+        """Walk the commits reachable from head (the current head of the
+        branch, if head is None) that are not reachable from since (all of
+        them, if since is None), oldest first.  For each commit this
+        yields a (name, parents, author, time, changes) tuple, where changes
+        is what diff_trees reports between the commit and its first parent.
+        For a merge, only the blobs that differ from those of every parent
+        are reported, and each change has the shas of the blob at the other
+        parents (None where there is none) appended.  Only the names of the commits come from Git; the
+        commits and trees are read through the batch process."""
+        args = ['rev-list', '--reverse', '--topo-order',
+                head or self.current_head()]
+        if since:
+            args.append('^' + since)
+        names = split(self.git(*args))
+
+        batch = self.get_batch()
+        trees = {}
+        commit_trees = {}
+        for i in range(0, len(names), batch.chunk_size):
+            chunk = names[i:i + batch.chunk_size]
+            for name, (kind, data) in zip(chunk, batch.get_objects(chunk)):
+                header = split(data[:data.find('\n\n')], '\n')
+                tree = unicode(header[0][5:])
+                parents = [unicode(line[7:]) for line in header
+                           if line[:7] == 'parent ']
+                author, time = None, None
+                for line in header:
+                    if line[:7] == 'author ':
+                        ident, time, zone = line[7:].rsplit(' ', 2)
+                        author = unicode(ident, "utf-8")
+                        time = int(time)
+                        break
+
+                parent_trees = []
+                for parent in parents:
+                    if not parent in commit_trees:
+                        kind, data = batch.get_object(parent)
+                        commit_trees[parent] = unicode(data[5:45])
+                    parent_trees.append(commit_trees[parent])
+                commit_trees[name] = tree
+
+                changes = self.diff_trees(parent_trees and parent_trees[0]
+                                          or None, tree, trees)
+                for other in parent_trees[1:]:
+                    changes = [change + (sha,) for change, sha in
+                               [(change, self.tree_entry(other, change[1],
+                                                         trees)[1])
+                                for change in changes]
+                               if sha != change[3]]
+
+                # Don't keep every tree in history in memory at once
+                if len(trees) > 10000:
+                    trees.clear()
+                yield (name, parents, author, time, changes)
+
     def close(self):
         if self.dirty:
             self.sync()
+        self.close_batch()
         del self.objects        # free it up right away
 
     def dump_objects(self, fd, indent=0, objects=None):
@@ -391,15 +1942,15 @@ class gitshelve(dict):
             fd.write('%stree %s\n' % (" " * indent, objects['__root__']))
             indent += 2
 
+        self.load_tree(objects)
         keys = objects.keys()
         keys.sort()
         for key in keys:
             if key == '__root__':
                 continue
-            assert isinstance(objects[key], dict)
 
-            if ('__book__' in objects[key]):
-                book = objects[key]['__book__']
+            book = book_of(objects[key])
+            if book is not None:
                 if book.name:
                     kind = 'blob ' + book.name
                 else:
@@ -419,11 +1970,35 @@ class gitshelve(dict):
         parts = split(path, os.sep)
         d = self.objects
         for part in parts:
+            if not isinstance(d, dict):
+                raise KeyError(path)
+            self.load_tree(d)
             if make_dirs and not (part in d):
                 d[part] = {}
             d = d[part]
+        if not isinstance(d, dict):
+            return {'__book__': d}      # only good for looking at
         return d
 
+    def get_book(self, path):
+        """Return the book kept at path, or raise KeyError."""
+        try:
+            book = book_of(self.get_tree(path))
+        except KeyError:
+            raise KeyError(path)
+        if book is None:
+            raise KeyError(path)
+        return book
+
+    def set_book(self, path, book):
+        """Keep book at path, in place of whatever was there."""
+        parts = split(path, os.sep)
+        d = self.objects
+        if len(parts) > 1:
+            d = self.get_tree(join(parts[:-1], os.sep), make_dirs=True)
+        self.load_tree(d)
+        d[self.compact_name(parts[-1])] = self.make_leaf(book)
+
     def get(self, key):
         path = '%s/%s' % (key[:2], key[2:])
         d = None
@@ -442,47 +2017,154 @@ class gitshelve(dict):
         book.dirty = False      # the blob was just written!
         book.path = '%s/%s' % (book.name[:2], book.name[2:])
 
-        d = self.get_tree(book.path, make_dirs=True)
-        d.clear()
-        d['__book__'] = book
+        self.set_book(book.path, book)
         self.dirty = True
+        self.dirty_paths.add(book.path)
 
         return book.name
 
-    def __getitem__(self, path):
-        d = None
+    # Files kept in the shelf, such as attachments, may be far larger than
+    # anything else in it.  They never go through git() or the batch
+    # process, both of which hold a whole object in memory and decode it as
+    # text: they are written to Git and read back a chunk at a time, as
+    # bytes, and their books are given no data.  Git itself only streams
+    # blobs above core.bigFileThreshold, so that is lowered for them.
+    file_chunk_size = 65536
+    file_stream_threshold = 16 * 1024 * 1024
+
+    def file_command(self, *args):
+        return ('-c', 'core.bigFileThreshold=%d' %
+                self.file_stream_threshold) + args
+
+    def write_file(self, source):
+        """Store the contents of source, either a file object or the name of
+        a file, as a blob, returning its name.  Git reads a named file, or a
+        file object open on a regular file, itself; anything else is copied
+        to it a chunk at a time, but then Git keeps all of it in memory
+        until it has the whole blob."""
+        args = ('hash-object', '-w', '--no-filters')
+        pipe = False
+        if isinstance(source, basestring):
+            args += ('--', source)
+            stdin = None
+        else:
+            args += ('--stdin',)
+            try:
+                regular = stat.S_ISREG(os.fstat(source.fileno()).st_mode) \
+                    and source.tell() == 0
+            except (AttributeError, IOError, OSError):
+                regular = False         # not backed by a file of its own
+            if regular:
+                stdin = source
+            else:
+                stdin = PIPE
+                pipe = True
+
+        if hooks:
+            start = time.time()
+        proc = git_stream(self.file_command(*args), self.repository, stdin)
+        size = 0
+        if pipe:
+            try:
+                try:
+                    while True:
+                        data = source.read(self.file_chunk_size)
+                        if not data:
+                            break
+                        if isinstance(data, unicode):
+                            data = data.encode("utf-8")
+                        proc.stdin.write(data)
+                        size += len(data)
+                except IOError:
+                    pass                # Git gave up; its error is below
+            finally:
+                proc.stdin.close()
+        name = proc.stdout.read()[:-1]
+        err = proc.stderr.read()
+        if proc.wait() != 0 or len(name) != 40:
+            raise GitError('hash-object', args[3:], {}, err)
+        if hooks:
+            notify('git', 'hash-object', time.time() - start, size, 41)
+        return unicode(name)
+
+    def set_file(self, path, name):
+        """Keep the blob name, as returned by write_file, in the shelf at
+        path.  Its contents are read back with iter_file."""
+        book = self.book_type(self, path)
+        book.name = name
+        book.dirty = False
+        self.set_book(path, book)
+        self.dirty = True
+        self.dirty_paths.add(path)
+
+    def file_size(self, name):
+        return int(self.git('cat-file', '-s', name))
+
+    def iter_file(self, name, chunk_size=None):
+        """Yield the contents of the blob name as byte strings of up to
+        chunk_size bytes each, read from Git as they are asked for."""
+        if hooks:
+            start = time.time()
+        proc = git_stream(self.file_command('cat-file', 'blob', name),
+                          self.repository)
+        size = 0
         try:
-            d = self.get_tree(path)
-        except KeyError:
-            raise KeyError(path)
+            while True:
+                data = proc.stdout.read(chunk_size or self.file_chunk_size)
+                if not data:
+                    break
+                size += len(data)
+                yield data
+        finally:
+            # If we were not read to the end, closing the pipe stops Git
+            proc.stdout.close()
+            err = proc.stderr.read()
+            status = proc.wait()
+        if status != 0:
+            raise GitError('cat-file', ('blob', name), {}, err)
+        if hooks:
+            notify('git', 'cat-file', time.time() - start, 0, size)
+
+    def copy_file(self, name, fd):
+        """Write the contents of the blob name to the file object fd."""
+        for data in self.iter_file(name):
+            fd.write(data)
 
-        if d and ('__book__' in d):
-            return d['__book__'].get_data()
-        else:
-            raise KeyError(path)
+    def __getitem__(self, path):
+        return self.get_book(path).get_data()
 
     def __setitem__(self, path, data):
-        d = self.get_tree(path, make_dirs=True)
-        if not ('__book__' in d):
-            d.clear()
-            d['__book__'] = self.book_type(self, path)
-        d['__book__'].set_data(data)
+        try:
+            book = self.get_book(path)
+        except KeyError:
+            book = self.book_type(self, path)
+            self.set_book(path, book)
+        book.set_data(data)
         self.dirty = True
+        self.dirty_paths.add(path)
+
+    def touch(self, path):
+        """Note that the data stored at path was changed in place, so that
+        it is written out again by the next commit."""
+        book = self.get_book(path)
+        book.get_data()
+        book.name = None
+        book.dirty = True
+        self.dirty = True
+        self.dirty_paths.add(path)
 
     def prune_tree(self, objects, paths):
+        if not isinstance(objects, dict):
+            raise KeyError(paths[0])
+        self.load_tree(objects)
         if len(paths) > 1:
             left = self.prune_tree(objects[paths[0]], paths[1:])
             # do not delete if there's something left besides __root__ and
             # paths[0]
             has_root = '__root__' in objects[paths[0]]
             if left > 0 or len(objects[paths[0]]) > int(has_root):
-                if '__root__' in objects:
-                    del objects['__root__']
-                for tree in objects:
-                    if '__root__' in objects[tree]:
-                        del objects[tree]['__root__']
                 return 3
-        l = len(objects[paths[0]])
+        l = len(book_of(objects[paths[0]]) and [1] or objects[paths[0]])
         del objects[paths[0]]
         self.dirty = True
         return l - 1
@@ -492,24 +2174,33 @@ class gitshelve(dict):
             self.prune_tree(self.objects, split(path, os.sep))
         except KeyError:
             raise KeyError(path)
+        self.dirty_paths.add(path)
 
     def __contains__(self, path):
-        d = self.get_tree(path)
-        return len(d.keys()) == 1 and ('__book__' in d)
+        try:
+            self.get_book(path)
+        except KeyError:
+            return False
+        return True
 
     def walker(self, kind, objects, path=''):
+        # Read this tree, and then all of its subtrees in one go, since they
+        # are about to be visited anyway.
+        self.load_tree(objects)
+        self.load_trees([obj for obj in objects.values()
+                         if isinstance(obj, dict) and '__lazy__' in obj])
+
         for item in objects.items():
             if item[0] == '__root__':
                 continue
-            assert isinstance(item[1], dict)
 
             if path:
                 key = join((path, item[0]), os.sep)
             else:
                 key = item[0]
 
-            if len(item[1].keys()) == 1 and ('__book__' in item[1]):
-                value = item[1]['__book__']
+            value = book_of(item[1])
+            if value is not None:
                 if kind == 'keys':
                     yield key
                 elif kind == 'values':
@@ -541,24 +2232,36 @@ class gitshelve(dict):
     def itervalues(self):
         return self.walker('values', self.objects)
 
+    def __reduce__(self):
+        # Being a dict, we would otherwise be pickled item by item
+        return (copy_reg.__newobj__, (self.__class__,), self.__getstate__())
+
     def __getstate__(self):
         self.sync()                   # synchronize before persisting
         odict = self.__dict__.copy()  # copy the dict since we change it
         del odict['dirty']            # remove dirty flag
+        if 'batch' in odict:
+            del odict['batch']        # a running process can't be pickled
+        if 'refreshed' in odict:
+            del odict['refreshed']
+        odict.pop('resolve', None)    # for the owner to give again
         return odict
 
     def __setstate__(self, ndict):
         self.__dict__.update(ndict)  # update attributes
         self.dirty = False
+        self.batch = None
 
-        # If the HEAD reference is out of date, throw away all data and
-        # rebuild it.
-        if not self.head or self.head != self.current_head():
-            self.read_repository()
+        # If the HEAD reference is out of date, bring the data up to date,
+        # and remember what changed for the benefit of our owner.
+        self.refreshed = self.refresh()
 
 
 def open(branch='master', repository=None, keep_history=True,
-         book_type=gitbook):
-    return gitshelve.open(branch, repository, keep_history, book_type)
+         book_type=gitbook, fast_import=True, lazy=False, jobs=1,
+         compact=None, optimistic=None, resolve=None):
+    return gitshelve.open(branch, repository, keep_history, book_type,
+                          fast_import, lazy, jobs, compact, optimistic,
+                          resolve)
 
 # gitshelve.py ends here
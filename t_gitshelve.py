@@ -8,12 +8,27 @@ import shutil
 import unittest
 import gitshelve
 import exceptions
+import cPickle
+from datetime import timedelta
 
 try:
     from cStringIO import StringIO
 except:
     from StringIO import StringIO
 
+class fields_gitbook(gitshelve.gitbook):
+    """Stores a dict of fields, one "key: value" line each."""
+    def serialize_data(self, data):
+        return ''.join(["%s: %s\n" % item for item in sorted(data.items())])
+
+    def deserialize_data(self, data):
+        return dict([line.split(': ', 1) for line in data.splitlines()])
+
+    def deserialize_partial_data(self, data, fields):
+        return dict([item for item in self.deserialize_data(data).items()
+                     if item[0] in fields])
+
+
 class t_gitshelve(unittest.TestCase):
     def setUp(self):
         if os.name == 'nt':
@@ -179,6 +194,609 @@ Author: .+
 Date:   .+
 """, log))
 
+    def testBatchRead(self):
+        shelf = gitshelve.open('test')
+        shelf['foo/bar/baz1.c'] = "Hello, this is a test\n"
+        shelf['foo/bar/baz2.c'] = "Hello, this is a change\n"
+        shelf.sync()
+        names = [shelf.get_tree('foo/bar/baz1.c')['__book__'].name,
+                 shelf.get_tree('foo/bar/baz2.c')['__book__'].name]
+        del shelf
+
+        shelf = gitshelve.open('test')
+        self.assertEqual(["Hello, this is a test\n",
+                          "Hello, this is a change\n",
+                          "Hello, this is a test\n"],
+                         shelf.get_blobs(names + names[:1]))
+        self.assertEqual("Hello, this is a change\n",
+                         shelf.get_blob(names[1]))
+
+        books = [shelf.get_tree(path)['__book__'] for path in
+                 ('foo/bar/baz1.c', 'foo/bar/baz2.c')]
+        shelf.load_books(books)
+        self.assertEqual("Hello, this is a test\n", books[0].data)
+        self.assertEqual("Hello, this is a change\n", books[1].data)
+
+        self.assertRaises(gitshelve.GitError, shelf.get_blob, '0' * 40)
+        self.assertEqual("Hello, this is a test\n", shelf.get_blob(names[0]))
+
+        shelf.close()
+        self.assertEqual(None, shelf.batch)
+
+    def testPartialRead(self):
+        shelf = gitshelve.open('test', book_type = fields_gitbook)
+        shelf['foo/one'] = {'title': 'One', 'body': 'Long text'}
+        shelf['foo/two'] = {'title': 'Two', 'body': 'More text'}
+        shelf.sync()
+        del shelf
+
+        shelf = gitshelve.open('test', book_type = fields_gitbook)
+        books = [shelf.get_tree(path)['__book__'] for path in
+                 ('foo/one', 'foo/two')]
+        self.assertEqual({'title': 'One'},
+                         books[0].get_partial_data(['title']))
+
+        # Books read in full are returned whole, and partial results are
+        # never kept
+        shelf.load_books(books[1:])
+        self.assertEqual([{'title': 'One'},
+                          {'title': 'Two', 'body': 'More text'}],
+                         shelf.load_partial_books(books, ['title']))
+        self.assertEqual(None, books[0].data)
+        self.assertEqual({'title': 'One', 'body': 'Long text'},
+                         books[0].get_data())
+
+        # Book types that cannot decode part of their data decode all of it
+        shelf = gitshelve.open('test')
+        book = shelf.get_tree('foo/one')['__book__']
+        self.assertEqual("body: Long text\ntitle: One\n",
+                         book.get_partial_data(['title']))
+        shelf.close()
+
+    def testParallelLoad(self):
+        shelf = gitshelve.open('test', book_type = fields_gitbook)
+        paths = []
+        for i in range(40):
+            path = '%02x/%d' % (i % 7, i)
+            shelf[path] = {'title': 'Issue %d' % i, 'body': u'\u010c' * i}
+            paths.append(path)
+        shelf.sync()
+        del shelf
+
+        loaded = []
+        for jobs in (1, 2, 0):
+            shelf = gitshelve.open('test', book_type = fields_gitbook,
+                                   lazy = True, jobs = jobs)
+            books = [shelf.get_tree(path)['__book__'] for path in paths]
+            shelf.load_books(books)
+            loaded.append([book.data for book in books])
+            shelf.close()
+
+        self.assertEqual(loaded[0], loaded[1])
+        self.assertEqual(loaded[0], loaded[2])
+        self.assertEqual({'title': 'Issue 3', 'body': u'\u010c' * 3},
+                         loaded[1][3])
+
+    def testInstrumentation(self):
+        stats = gitshelve.gitstats()
+        gitshelve.hooks.append(stats)
+        try:
+            shelf = gitshelve.open('test')
+            shelf['foo/bar/baz1.c'] = "Hello, this is a test\n"
+            shelf['foo/bar/baz2.c'] = "Hello, this is a change\n"
+            shelf.commit('first\n')
+            name = shelf.get_tree('foo/bar/baz1.c')['__book__'].name
+            shelf.get_blobs([name, name])
+            shelf.close()
+        finally:
+            gitshelve.hooks.remove(stats)
+
+        rows = dict([(row['name'], row) for row in stats.summary()
+                     if row['kind'] == 'git'])
+        self.assertEqual(1, rows['fast-import']['calls'])
+        self.assert_(rows['fast-import']['input_bytes'] > 0)
+        self.assertEqual(2, rows['cat-file --batch']['count'])
+        self.assertEqual(2 * len("Hello, this is a test\n"),
+                         rows['cat-file --batch']['output_bytes'])
+        self.assert_(rows['fast-import']['elapsed'] > 0)
+
+        # Nothing is reported once the hook is gone
+        count = len(stats.summary())
+        gitshelve.git('rev-parse', 'test')
+        self.assertEqual(count, len(stats.summary()))
+
+    def testDirtyPaths(self):
+        for fast_import in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', fast_import = fast_import)
+            for path in ('a/1', 'a/2', 'b/1', 'c/d/1'):
+                shelf[path] = "Data in %s\n" % path
+            shelf.commit('first\n')
+            self.assertEqual(set(), shelf.dirty_paths)
+
+            # Deleting leaves the trees next to it alone
+            del shelf['a/1']
+            shelf['c/d/2'] = "Data in c/d/2\n"
+            self.assertEqual(set(['a/1', 'c/d/2']), shelf.dirty_paths)
+            self.assertEqual(set(['', 'a', 'c', 'c/d']), shelf.dirty_trees())
+            b_root = shelf.objects['b']['__root__']
+
+            shelf.commit('second\n')
+            self.assertEqual(set(), shelf.dirty_paths)
+            self.assertEqual(b_root, shelf.objects['b']['__root__'])
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            self.assertEqual("a/2\nb/1\nc/d/1\nc/d/2",
+                             gitshelve.git('ls-tree', '-r', '--name-only',
+                                           'test'))
+            shelf.close()
+
+    def testTouch(self):
+        shelf = gitshelve.open('test', book_type = fields_gitbook)
+        shelf['a/1'] = {'status': 'open'}
+        shelf['b/1'] = {'status': 'open'}
+        shelf.commit('first\n')
+        del shelf
+
+        shelf = gitshelve.open('test', book_type = fields_gitbook)
+        shelf['a/1']['status'] = 'closed'
+        self.assertFalse(shelf.dirty)
+        shelf.touch('a/1')
+        self.assertEqual(set(['a/1']), shelf.dirty_paths)
+        shelf.commit('second\n')
+        self.assertEqual("status: closed\n",
+                         gitshelve.git('cat-file', 'blob', 'test:a/1',
+                                       keep_newline=True))
+        self.assertRaises(KeyError, shelf.touch, 'c/1')
+        shelf.close()
+
+    def testBulkTransfer(self):
+        shelf = gitshelve.open('test')
+        for path in ('a/1', 'a/2', 'b/1', 'c/d/1', 'c/d/2'):
+            shelf[path] = "Data in %s\n" % path
+        shelf.commit('first\n')
+        shelf['e/1'] = "Not committed yet\n"
+        items = list(shelf.iterblobs(chunk_size = 2))
+        self.assertEqual(6, len(items))
+        self.assertEqual(u"Data in c/d/2\n", dict(items)['c/d/2'])
+        self.assertEqual(u"Not committed yet\n", dict(items)['e/1'])
+        shelf.commit('second\n')
+        del shelf
+
+        gitshelve.git('branch', '-D', 'test')
+        shelf = gitshelve.open('test')
+        self.assertEqual(6, len(shelf.import_blobs(iter(items))))
+        shelf.commit('imported\n')
+        self.assertEqual(u"Not committed yet\n", shelf['e/1'])
+        self.assertEqual(shelf.objects['__root__'],
+                         gitshelve.git('rev-parse', 'test^{tree}'))
+        self.assertEqual("a/1\na/2\nb/1\nc/d/1\nc/d/2\ne/1",
+                         gitshelve.git('ls-tree', '-r', '--name-only',
+                                       'test'))
+
+        # Importing the same data again changes nothing
+        self.assertEqual([], shelf.import_blobs(items))
+        self.assertFalse(shelf.dirty)
+
+        # Nor does an import that fast-import fails to finish
+        def failing_close(importer):
+            importer.abort()
+            raise gitshelve.GitError('fast-import', (), {}, 'Made to fail')
+        close = gitshelve.gitimport.close
+        gitshelve.gitimport.close = failing_close
+        try:
+            self.assertRaises(gitshelve.GitError, shelf.import_blobs,
+                              [('a/1', "Changed\n"), ('f/1', "New\n")])
+        finally:
+            gitshelve.gitimport.close = close
+        self.assertFalse(shelf.dirty)
+        self.assertEqual(u"Data in a/1\n", shelf['a/1'])
+        self.assertFalse('f/1' in shelf)
+        shelf.close()
+
+    def testCommitBackends(self):
+        dumps = []
+        for fast_import in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', fast_import = fast_import)
+            shelf['foo/bar/baz1.c'] = "Hello, this is a test\n"
+            shelf['foo/quux.c'] = "Hello, this is a change\n"
+            shelf['odd/with space "quoted"\nname'] = "Odd names\n"
+            shelf.commit('first\n')
+
+            shelf['foo/bar/baz1.c'] = "Hello, this is another change\n"
+            shelf['alpha/beta.c'] = "Hello, this is a test\n"
+            del shelf['odd']
+            shelf.commit('second\n')
+
+            buf = StringIO()
+            shelf.dump_objects(buf)
+            dumps.append(buf.getvalue())
+
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            self.assertEqual(shelf.get_tree('foo/bar')['__root__'],
+                             gitshelve.git('rev-parse', 'test:foo/bar'))
+            self.assertEqual(2, len(gitshelve.git('rev-list', 'test').split()))
+            del shelf
+
+        self.assertEqual(dumps[0], dumps[1])
+        self.assertEqual('', gitshelve.git('for-each-ref', 'refs/gitshelve'))
+
+    def testFailedImport(self):
+        shelf = gitshelve.open('test')
+        shelf['a/x'] = "Hello, this is a test\n"
+        shelf.commit('first\n')
+        head = shelf.head
+
+        def failing_commit(importer, *args):
+            raise gitshelve.GitError('fast-import', (), {}, 'Made to fail')
+        commit = gitshelve.gitimport.commit
+        gitshelve.gitimport.commit = failing_commit
+        try:
+            shelf['a/x'] = "Hello, this is a change\n"
+            shelf['a/b/y'] = "Hello, this is new\n"
+            self.assertRaises(gitshelve.GitError, shelf.commit, 'second\n')
+        finally:
+            gitshelve.gitimport.commit = commit
+
+        # Nothing was taken to be written, so committing again works
+        self.assertEqual(head, shelf.head)
+        self.assertTrue(shelf.get_book('a/x').dirty)
+        shelf.commit('second\n')
+        self.assertEqual(shelf.objects['__root__'],
+                         gitshelve.git('rev-parse', 'test^{tree}'))
+        self.assertEqual("Hello, this is new\n",
+                         gitshelve.git('show', 'test:a/b/y',
+                                       keep_newline=True))
+        self.assertEqual('', gitshelve.git('for-each-ref', 'refs/gitshelve'))
+        del shelf
+
+    def testObjectHashing(self):
+        for text in ("", "Hello, this is a test\n", u"\u010c\u0161 text\n"):
+            self.assertEqual(gitshelve.git('hash-object', '--stdin',
+                                           input = text),
+                             gitshelve.hash_object('blob', text))
+
+        blob = gitshelve.git('hash-object', '-w', '--stdin', input = "x\n")
+        entries = [('100644', 'foo.c', blob),
+                   ('100644', 'foo', blob),
+                   ('100644', u'\u010cesky', blob),
+                   ('100644', 'foo-bar', blob)]
+        tree = gitshelve.git('mktree', '-z', input = ''.join(
+            ["100644 blob %s\t%s\0" % (str(sha), name.encode('utf-8'))
+             for mode, name, sha in entries]))
+        self.assertEqual(tree, gitshelve.hash_tree(entries))
+
+        # A subtree sorts as though its name ended with a slash, so 'foo'
+        # the directory comes after 'foo-bar' and 'foo.c'.
+        entries.remove(('100644', 'foo', blob))
+        entries.append(('40000', 'foo', tree))
+        outer = gitshelve.git('mktree', '-z', input = ''.join(
+            ["%s %s %s\t%s\0" % (mode == '40000' and '040000' or mode,
+                                 mode == '40000' and 'tree' or 'blob',
+                                 str(sha), name.encode('utf-8'))
+             for mode, name, sha in entries]))
+        self.assertEqual(outer, gitshelve.hash_tree(entries))
+
+    def testLazyLoading(self):
+        shelf = gitshelve.open('test')
+        text = "Hello, this is a test\n"
+        shelf['foo/bar/baz1.c'] = text
+        shelf['foo/bar/baz2.c'] = text
+        shelf['alpha/beta/baz3.c'] = text
+        shelf['apple/orange/baz4.c'] = text
+        shelf.sync()
+        del shelf
+
+        for fast_import in (False, True):
+            shelf = gitshelve.open('test', fast_import = fast_import,
+                                   lazy = True)
+            self.assertEqual(['__lazy__', '__root__'],
+                             sorted(shelf.objects.keys()))
+
+            self.assertEqual(text, shelf['foo/bar/baz1.c'])
+            self.assert_('__lazy__' in shelf.objects['alpha'])
+            self.assert_('__lazy__' not in shelf.get_tree('foo/bar'))
+            self.assert_('foo/bar/baz2.c' in shelf)
+
+            shelf['foo/bar/baz1.c'] = "Hello, this is a change\n"
+            del shelf['apple/orange/baz4.c']
+            shelf.commit('lazy\n')
+            self.assert_('__lazy__' in shelf.objects['alpha'])
+
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            self.assertEqual(shelf.objects['alpha']['__root__'],
+                             gitshelve.git('rev-parse', 'test:alpha'))
+
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['alpha/beta/baz3.c', 'foo/bar/baz1.c',
+                              'foo/bar/baz2.c'], keys)
+            del shelf
+
+            shelf = gitshelve.open('test', lazy = True)
+            self.assertEqual("Hello, this is a change\n",
+                             shelf['foo/bar/baz1.c'])
+            buf = StringIO()
+            shelf.dump_objects(buf)
+            self.assertEqual("""tree %s
+  tree %s: alpha
+    tree %s: beta
+      blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: baz3.c
+  tree %s: foo
+    tree %s: bar
+      blob fb54a7573d864d4b57ffcc8af37e7565e2ba4608: baz1.c
+      blob ea93d5cc5f34e13d2a55a5866b75e2c58993d253: baz2.c
+""" % tuple([gitshelve.git('rev-parse', 'test:' + path) for path in
+             ('', 'alpha', 'alpha/beta', 'foo', 'foo/bar')]),
+                             buf.getvalue())
+
+            shelf['foo/bar/baz1.c'] = text
+            shelf['apple/orange/baz4.c'] = text
+            shelf.commit('restore\n')
+            del shelf
+
+    def testRefresh(self):
+        text = "Hello, this is a test\n"
+        for lazy in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', lazy = lazy)
+            shelf['foo/bar/baz1.c'] = text
+            shelf['foo/bar/baz2.c'] = text
+            shelf['alpha/beta/baz3.c'] = text
+            shelf.sync()
+            self.assertEqual(text, shelf['foo/bar/baz1.c'])
+            pickled = cPickle.dumps(shelf)
+
+            other = gitshelve.open('test')
+            other['foo/bar/baz1.c'] = "Hello, this is a change\n"
+            other['foo/new/baz4.c'] = text
+            del other['alpha']
+            other.sync()
+
+            shelf = cPickle.loads(pickled)
+            changes = shelf.refreshed
+            changes.sort()
+            self.assertEqual([('A', 'foo/new/baz4.c'),
+                              ('D', 'alpha/beta/baz3.c'),
+                              ('M', 'foo/bar/baz1.c')], changes)
+            self.assertEqual(other.head, shelf.head)
+
+            self.assertEqual("Hello, this is a change\n",
+                             shelf['foo/bar/baz1.c'])
+            self.assertEqual(text, shelf['foo/new/baz4.c'])
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['foo/bar/baz1.c', 'foo/bar/baz2.c',
+                              'foo/new/baz4.c'], keys)
+
+            buf1 = StringIO()
+            shelf.dump_objects(buf1)
+            buf2 = StringIO()
+            other.dump_objects(buf2)
+            self.assertEqual(buf2.getvalue(), buf1.getvalue())
+
+            shelf['foo/bar/baz2.c'] = "Hello, this is a change\n"
+            shelf.sync()
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+
+            self.assertEqual([], cPickle.loads(cPickle.dumps(shelf)).refreshed)
+            del shelf
+            del other
+
+    def testHistory(self):
+        text = "Hello, this is a test\n"
+        shelf = gitshelve.open('test')
+        shelf['foo/bar/baz1.c'] = text
+        shelf['alpha/beta/baz2.c'] = text
+        first = shelf.commit('first')
+        shelf['foo/bar/baz1.c'] = "Hello, this is a change\n"
+        shelf['foo/new/baz3.c'] = text
+        second = shelf.commit('second')
+        del shelf['alpha']
+        third = shelf.commit('third')
+
+        history = list(shelf.history())
+        self.assertEqual([first, second, third],
+                         [name for name, parents, author, time, changes
+                          in history])
+        self.assertEqual([[], [first], [second]],
+                         [parents for name, parents, author, time, changes
+                          in history])
+        self.assertEqual(['alpha/beta/baz2.c', 'foo/bar/baz1.c'],
+                         [change[1] for change in history[0][4]])
+        self.assertEqual([('M', 'foo/bar/baz1.c'), ('A', 'foo/new/baz3.c')],
+                         [change[:2] for change in history[1][4]])
+        self.assertEqual([('D', 'alpha/beta/baz2.c',
+                           gitshelve.hash_object('blob', text), None)],
+                         history[2][4])
+        self.assertEqual(gitshelve.git('log', '-1', '--format=%an <%ae>',
+                                       third), history[2][2])
+
+        # Only what came after the given commit is walked
+        self.assertEqual([second, third],
+                         [entry[0] for entry in shelf.history(first)])
+        self.assertEqual([], list(shelf.history(third)))
+        self.assertEqual([second],
+                         [entry[0] for entry in shelf.history(first, second)])
+        self.assertTrue(shelf.is_ancestor(first, third))
+        self.assertFalse(shelf.is_ancestor(third, first))
+        del shelf
+
+    def testMerge(self):
+        text = "Hello, this is a test\n"
+        for fast_import in (True, False):
+            for branch in ('test', 'test-other'):
+                try: gitshelve.git('branch', '-D', branch)
+                except: pass
+
+            shelf = gitshelve.open('test', fast_import = fast_import)
+            shelf['a/x'] = text
+            shelf['a/y'] = text
+            shelf['b/z'] = text
+            base = shelf.commit('base')
+
+            gitshelve.git('branch', 'test-other', base)
+            other = gitshelve.open('test-other', fast_import = fast_import)
+            other['a/x'] = "Changed by them\n"
+            other['c/w'] = text
+            del other['b/z']
+            theirs = other.commit('theirs')
+
+            shelf['a/y'] = "Changed by us\n"
+            ours = shelf.commit('ours')
+
+            changes = shelf.merge(theirs)
+            changes.sort()
+            self.assertEqual([('A', 'c/w'), ('D', 'b/z'), ('M', 'a/x')],
+                             changes)
+            self.assertEqual([ours, theirs], shelf.get_parent_ids())
+            self.assertEqual("Changed by them\n", shelf['a/x'])
+            self.assertEqual("Changed by us\n", shelf['a/y'])
+            self.assertFalse('b/z' in shelf)
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            self.assertEqual([], shelf.merge(theirs))
+
+            # Both sides changing the same blob needs resolving
+            other['a/x'] = "Changed by them again\n"
+            theirs = other.commit('theirs again')
+            shelf['a/x'] = "Changed by us too\n"
+            shelf.commit('ours again')
+            head = shelf.head
+            self.assertRaises(gitshelve.GitError, shelf.merge, theirs)
+            self.assertEqual(head, shelf.head)
+
+            def resolve(path, base, ours, theirs):
+                return ours + theirs
+            self.assertEqual([('M', 'a/x')], shelf.merge(theirs, resolve))
+            self.assertEqual("Changed by us too\nChanged by them again\n",
+                             gitshelve.git('show', 'test:a/x',
+                                           keep_newline=True))
+
+            # They have everything we have, so we just catch up
+            other = gitshelve.open('test-other', fast_import = fast_import)
+            other.merge(shelf.head)
+            other['c/w'] = "Changed by them once more\n"
+            theirs = other.commit('fast-forward')
+            self.assertEqual([('M', 'c/w')], shelf.merge(theirs))
+            self.assertEqual(theirs, shelf.head)
+            self.assertEqual("Changed by them once more\n", shelf['c/w'])
+            del shelf
+            del other
+
+        gitshelve.git('branch', '-D', 'test-other')
+
+    def testConcurrentWriters(self):
+        text = "Hello, this is a test\n"
+        for lazy in (False, True):
+            try: gitshelve.git('branch', '-D', 'test')
+            except: pass
+
+            shelf = gitshelve.open('test', lazy = lazy)
+            shelf['a/x'] = text
+            shelf['b/y'] = text
+            shelf['c/z'] = text
+            shelf.commit('base')
+
+            other = gitshelve.open('test', lazy = lazy)
+            other['a/x'] = "Changed by them\n"
+            other['b/w'] = text
+            other.commit('theirs')
+
+            # Losing the race leaves our changes in place
+            shelf['c/z'] = "Changed by us\n"
+            del shelf['b/y']
+            self.assertRaises(gitshelve.HeadMoved, shelf.commit, 'ours')
+            self.assertTrue(shelf.dirty)
+            self.assertEqual(other.head, gitshelve.git('rev-parse', 'test'))
+
+            shelf.optimistic = True
+            shelf.commit('ours')
+            self.assertEqual([other.head], shelf.get_parent_ids())
+            self.assertEqual([('A', 'b/w'), ('M', 'a/x')],
+                             sorted(shelf.rebased))
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['a/x', 'b/w', 'c/z'], keys)
+            self.assertEqual("Changed by them\n", shelf['a/x'])
+            self.assertEqual("Changed by us\n", shelf['c/z'])
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            self.assertEqual("Changed by us\n",
+                             gitshelve.git('show', 'test:c/z',
+                                           keep_newline=True))
+
+            # A directory we emptied comes back with what they put in it
+            other = gitshelve.open('test', lazy = lazy)
+            other['b/v'] = text
+            other.commit('theirs again')
+            del shelf['b/w']
+            shelf.commit('ours again')
+            keys = shelf.keys()
+            keys.sort()
+            self.assertEqual(['a/x', 'b/v', 'c/z'], keys)
+            self.assertEqual(shelf.objects['__root__'],
+                             gitshelve.git('rev-parse', 'test^{tree}'))
+            del shelf
+            del other
+
+    def testConcurrentSamePath(self):
+        base = "line1\nline2\n"
+        def resolve(path, base, ours, theirs):
+            # Each line comes from whichever side changed it
+            return ''.join([o != b and o or t for b, o, t in
+                            zip(base.splitlines(True), ours.splitlines(True),
+                                theirs.splitlines(True))])
+
+        for fast_import in (True, False):
+            for resolver in (None, resolve):
+                try: gitshelve.git('branch', '-D', 'test')
+                except: pass
+
+                shelf = gitshelve.open('test')
+                shelf['x/f'] = base
+                shelf['x/g'] = base
+                shelf.commit('base')
+                first = gitshelve.open('test', fast_import = fast_import)
+                second = gitshelve.open('test', fast_import = fast_import,
+                                        optimistic = True, resolve = resolver)
+
+                first['x/f'] = "line1 CHANGED-BY-A\nline2\n"
+                head = first.commit('first')
+                second['x/f'] = "line1\nline2 CHANGED-BY-B\n"
+                second['x/g'] = "Only changed by B\n"
+
+                if resolver is None:
+                    # Nothing is overwritten, and nothing is lost either
+                    self.assertRaises(gitshelve.HeadMoved, second.commit,
+                                      'second')
+                    self.assertEqual(head, gitshelve.git('rev-parse', 'test'))
+                    self.assertTrue(second.dirty)
+                    self.assertEqual("line1\nline2 CHANGED-BY-B\n",
+                                     second['x/f'])
+                else:
+                    second.commit('second')
+                    self.assertEqual("line1 CHANGED-BY-A\nline2 CHANGED-BY-B\n",
+                                     gitshelve.git('show', 'test:x/f',
+                                                   keep_newline=True))
+                    self.assertEqual("Only changed by B\n",
+                                     gitshelve.git('show', 'test:x/g',
+                                                   keep_newline=True))
+                    self.assertEqual([('M', 'x/f')], second.rebased)
+                del shelf
+                del first
+                del second
+
     def testDetachedRepo(self):
         repotest = os.path.join(self.tmpdir, 'repo-test')
         repotestclone = os.path.join(self.tmpdir, 'repo-test-clone')
@@ -209,6 +827,80 @@ Date:   .+
             if os.path.isdir(repotest):
                 shutil.rmtree(repotest)
 
+    def testRepositoryFiles(self):
+        repotest = os.path.join(self.tmpdir, 'repo-files-test')
+        shelf = gitshelve.open(repository = repotest)
+        shelf['foo.txt'] = "Hello, world!\n"
+        try:
+            shelf.sync()
+            head = gitshelve.git('rev-parse', 'master', repository = repotest)
+            self.assertEqual(head, gitshelve.read_ref('refs/heads/master',
+                                                      repotest))
+            self.assertEqual(None, gitshelve.read_ref('refs/heads/missing',
+                                                      repotest))
+            gitshelve.git('pack-refs', '--all', repository = repotest)
+            self.assertEqual(head, gitshelve.read_ref('refs/heads/master',
+                                                      repotest))
+
+            for key, value in (('issues.branch', 'tracker'),
+                               ('user.name', 'J\xc3\xb6 "Q" Tester'),
+                               ('user.email', 'jo@example.com # not a comment'),
+                               ('remote.Origin Name.url', 'x;y\tz')):
+                gitshelve.git('config', key, value, repository = repotest)
+            config = gitshelve.read_config(repotest)
+            self.assertEqual('tracker', config['issues.branch'])
+            self.assertEqual(u'J\u00f6 "Q" Tester', config['user.name'])
+            self.assertEqual('jo@example.com # not a comment',
+                             config['user.email'])
+            self.assertEqual('x;y\tz', config['remote.Origin Name.url'])
+        finally:
+            del shelf
+            if os.path.isdir(repotest):
+                shutil.rmtree(repotest)
+
+    def testSystemConfig(self):
+        """Test finding the system configuration of a Git installed under
+        some other prefix than /usr."""
+        repotest = os.path.join(self.tmpdir, 'repo-system-test')
+        bindir = os.path.join(self.tmpdir, 'prefix-bin')
+        sysconfig = os.path.join(self.tmpdir, 'prefix-gitconfig')
+        path = os.environ['PATH']
+        try:
+            gitshelve.git('init', '-q', repository = repotest)
+            os.mkdir(bindir)
+            fd = open(os.path.join(bindir, 'git'), 'w')
+            fd.write('#!/bin/sh\n'
+                     'if [ "$1" = var ]; then echo %s; exit 0; fi\n'
+                     'exec %s "$@"\n' % (sysconfig, gitshelve.find_git()))
+            fd.close()
+            os.chmod(os.path.join(bindir, 'git'), 0755)
+            fd = open(sysconfig, 'w')
+            fd.write('[issues]\n\tbranch = system-tracker\n')
+            fd.close()
+            os.environ['PATH'] = bindir + os.pathsep + path
+
+            config = gitshelve.read_config(repotest)
+            self.assertEqual('system-tracker', config['issues.branch'])
+            self.assertEqual(sysconfig, gitshelve.system_config_path())
+
+            # Nothing is written into the repository, and a Git that cannot
+            # name the file leaves the reading to `git config'
+            self.assertFalse(os.path.exists(os.path.join(repotest,
+                                                         'gitshelve-config')))
+            os.environ['PATH'] = path
+            self.assertNotEqual(sysconfig, gitshelve.system_config_path())
+            gitshelve.git('config', 'issues.branch', 'local-tracker',
+                          repository = repotest)
+            self.assertEqual('local-tracker',
+                             gitshelve.read_config(repotest)['issues.branch'])
+        finally:
+            os.environ['PATH'] = path
+            for directory in (repotest, bindir):
+                if os.path.isdir(directory):
+                    shutil.rmtree(directory)
+            if os.path.isfile(sysconfig):
+                os.remove(sysconfig)
+
     def testBlobStore(self):
         """Test use a gitshelve as a generic blob store."""
         try:
@@ -247,8 +939,202 @@ Date:   .+
             if os.path.isdir(blobpath):
                 shutil.rmtree(blobpath)
 
+    def testFiles(self):
+        """Test storing binary files a chunk at a time."""
+        try:
+            filepath = os.path.join(self.tmpdir, 'files')
+            shelf = gitshelve.open(repository = filepath, keep_history = False)
+            data = ''.join([chr(i % 256) for i in range(200000)])
+
+            name = shelf.write_file(StringIO(data))
+            self.assertEqual(gitshelve.hash_object('blob', data), name)
+            datapath = os.path.join(self.tmpdir, 'data.bin')
+            fd = open(datapath, 'wb')
+            fd.write(data)
+            fd.close()
+            self.assertEqual(name, shelf.write_file(datapath))
+            fd = open(datapath, 'rb')
+            self.assertEqual(name, shelf.write_file(fd))
+            fd.close()
+            os.remove(datapath)
+
+            shelf.set_file('a/data.bin', name)
+            shelf['a/note'] = "A note\n"
+            shelf.commit('Added a file')
+            del shelf
+
+            shelf = gitshelve.open(repository = filepath, keep_history = False)
+            name = shelf.get_book('a/data.bin').name
+            self.assertEqual(len(data), shelf.file_size(name))
+            chunks = list(shelf.iter_file(name, 65536))
+            self.assertEqual([65536, 65536, 65536, 3392],
+                             [len(chunk) for chunk in chunks])
+            self.assertEqual(data, ''.join(chunks))
+
+            buf = StringIO()
+            shelf.copy_file(name, buf)
+            self.assertEqual(data, buf.getvalue())
+
+            # Stopping early is fine, and a missing blob is an error
+            self.assertEqual(data[:10], shelf.iter_file(name, 10).next())
+            self.assertRaises(gitshelve.GitError, list,
+                              shelf.iter_file('0' * 40))
+
+            self.assertEqual([('a/note', "A note\n")],
+                             list(shelf.iterblobs(select=lambda path:
+                                                  path != 'a/data.bin')))
+            del shelf
+        finally:
+            if os.path.isdir(filepath):
+                shutil.rmtree(filepath)
+
+class t_gitshelve_compact(t_gitshelve):
+    """Runs the same tests against shelves keeping their books compactly."""
+    def setUp(self):
+        t_gitshelve.setUp(self)
+        gitshelve.gitshelve.compact = True
+
+    def tearDown(self):
+        gitshelve.gitshelve.compact = False
+        t_gitshelve.tearDown(self)
+
+    def testCompactPickle(self):
+        shelf = gitshelve.open('test')
+        shelf['a/b'] = "Hello"
+        shelf.commit('first')
+        self.assertTrue(isinstance(shelf.objects['a']['b'], gitshelve.gitbook))
+
+        for protocol in (0, 2):
+            copy = cPickle.loads(cPickle.dumps(shelf, protocol))
+            self.assertEqual("Hello", copy['a/b'])
+            self.assertEqual(shelf.get_book('a/b').name,
+                             copy.get_book('a/b').name)
+        del shelf
+
+def load_git_issues():
+    """Import the git-issues script as a module, without running a
+    command."""
+    import imp
+    argv, dont_write = sys.argv, sys.dont_write_bytecode
+    sys.argv = [os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             'git-issues')]
+    sys.dont_write_bytecode = True
+    try:
+        return imp.load_source('git_issues', sys.argv[0])
+    finally:
+        sys.argv, sys.dont_write_bytecode = argv, dont_write
+
+class t_gitissues(unittest.TestCase):
+    """Tests what git-issues builds on top of gitshelve."""
+    def setUp(self):
+        self.gi = load_git_issues()
+
+    def copy(self, obj):
+        gi = self.gi
+        return gi.object_from_string(gi.object_to_string(obj))
+
+    def testMergeSameField(self):
+        gi = self.gi
+        base = gi.Issue(None, gi.Person(u'A', u'a@example.com'), u'Title',
+                        priority=u'medium')
+        ours, theirs = self.copy(base), self.copy(base)
+
+        # Both sides set the priority, ours a minute before theirs
+        ours.set_priority(u'low')
+        ours.modified -= timedelta(minutes=1)
+        theirs.set_priority(u'critical')
+        theirs.set_title(u'Title changed by them')
+        ours, theirs = self.copy(ours), self.copy(theirs)
+        self.assertNotEqual(None, ours.modified)
+        self.assertTrue(theirs.modified > ours.modified)
+
+        merged = gi.merge_objects('ab/cd/issue.xml', base, ours, theirs)
+        self.assertEqual(u'critical', merged.priority)
+        self.assertEqual(u'Title changed by them', merged.title)
+
+        # Now ours is the later change, and only ours changed the status
+        ours, theirs = self.copy(merged), self.copy(merged)
+        theirs.set_priority(u'high')
+        theirs.modified -= timedelta(minutes=1)
+        ours.set_priority(u'blocker')
+        ours.set_status(u'closed')
+        merged = gi.merge_objects('ab/cd/issue.xml', self.copy(merged),
+                                  self.copy(ours), self.copy(theirs))
+        self.assertEqual(u'blocker', merged.priority)
+        self.assertEqual(u'closed', merged.status)
+
+    def testIssueFormat(self):
+        gi = self.gi
+        issue = gi.Issue(None, gi.Person(u'A', u'a@example.com'), u'Title')
+        data = gi.object_to_string(issue)
+
+        # Issues already in repositories must not be rewritten in full
+        self.assertEqual(['issue', 'created', 'author', 'title', 'summary',
+                          'description', 'reporters', 'owners', 'assigned',
+                          'carbons', 'status', 'resolution', 'type',
+                          'components', 'version', 'milestone', 'severity',
+                          'priority', 'tags', 'modified'],
+                         [tag for tag in re.findall(r'^<(\w+)', data, re.M)
+                          if tag not in ('person', 'name', 'email',
+                                         'datetime', 'list')])
+        partial = gi.object_from_string(data, ('title', 'status'))
+        self.assertEqual(u'Title', partial.title)
+        self.assertEqual(issue.status, partial.status)
+
+    def testHistoryOfMerge(self):
+        gi = self.gi
+        for branch in ('test', 'test-other'):
+            try: gitshelve.git('branch', '-D', branch)
+            except: pass
+
+        def resolve(path, base, ours, theirs):
+            return gi.object_to_string(gi.merge_objects(
+                path, *[gi.object_from_string(data)
+                        for data in (base, ours, theirs)]))
+
+        issue = gi.Issue(None, gi.Person(u'A', u'a@example.com'), u'Title',
+                         priority=u'medium')
+        shelf = gitshelve.open('test')
+        shelf['ab/cdef/issue.xml'] = gi.object_to_string(issue)
+        base = shelf.commit('base')
+
+        # Each side changes a different field
+        gitshelve.git('branch', 'test-other', base)
+        other = gitshelve.open('test-other')
+        issue = gi.object_from_string(other['ab/cdef/issue.xml'])
+        issue.set_title(u'Title changed by them')
+        other['ab/cdef/issue.xml'] = gi.object_to_string(issue)
+        other['ab/cdef/comment_1234_20260101000000000000.xml'] = "comment"
+        theirs = other.commit('theirs')
+
+        issue = gi.object_from_string(shelf['ab/cdef/issue.xml'])
+        issue.set_priority(u'low')
+        shelf['ab/cdef/issue.xml'] = gi.object_to_string(issue)
+        ours = shelf.commit('ours')
+        shelf.merge(theirs, resolve)
+
+        index = gi.HistoryIndex()
+        self.assertTrue(index.update(shelf))
+        entries = index.lookup('abcdef')
+        self.assertEqual([base, ours, theirs],
+                         sorted([entry[0] for entry in entries[:3]],
+                                key=[base, ours, theirs].index))
+        self.assertEqual(shelf.head, entries[-1][0])
+
+        # The merge itself changed nothing that either side did not
+        self.assertEqual([], entries[-1][3])
+        changes = [change for entry in entries for change in entry[3]]
+        self.assertEqual(1, changes.count(('priority', u'medium', u'low')))
+        self.assertEqual(1, changes.count(('title', u'Title',
+                                           u'Title changed by them')))
+        self.assertEqual(1, changes.count(('comment', None, '1234')))
+        del shelf, other
+
 def suite():
-    return unittest.TestLoader().loadTestsFromTestCase(t_gitshelve)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite((loader.loadTestsFromTestCase(t_gitshelve),
+                               loader.loadTestsFromTestCase(t_gitshelve_compact),
+                               loader.loadTestsFromTestCase(t_gitissues)))
 
 if __name__ == '__main__':
     unittest.main()